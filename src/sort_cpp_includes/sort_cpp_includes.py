@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import dataclasses
+import fnmatch
+import heapq
+import io
 import shlex
 import json
 import os
+import queue
 import re
+import select
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 import typing
 import yaml
 
+try:
+    from . import spawn_helper
+except ImportError:
+    # Run as a script, not as a part of the package
+    import spawn_helper
+
 
 def read_file_contents(path: str) -> str:
     with open(path, 'r') as ifile:
@@ -23,13 +38,47 @@ class CCEntry:
     directory: str
     command: typing.List[str]
     file_path: str
+    _include_flags: typing.Optional[typing.Tuple[str, ...]] = (
+        dataclasses.field(default=None, repr=False, compare=False)
+    )
+
+    # The compiler and the flags affecting header search. Equal flags of
+    # different entries are the same object, so the cache keys share it.
+    def include_flags(self) -> typing.Tuple[str, ...]:
+        if self._include_flags is None:
+            flags = extract_include_flags(self.command)
+            self._include_flags = INTERNED_INCLUDE_FLAGS.setdefault(
+                flags, flags,
+            )
+        return self._include_flags
+
+
+INTERNED_INCLUDE_FLAGS: typing.Dict[
+    typing.Tuple[str, ...], typing.Tuple[str, ...]
+] = {}
 
 
 @dataclasses.dataclass
 class Include:
     include_line: str  # e.g. '#include <stdio.h>'
     orig_path: str  # e.g. 'stdio.h'
-    real_path: str  # e.g. '/usr/include/stdio.h'
+    resolved_path: typing.Optional[str] = None  # e.g. '/usr/include/stdio.h'
+    # Asking the compiler is expensive, so the path is resolved on demand
+    resolver: typing.Optional[typing.Callable[[], str]] = dataclasses.field(
+        default=None, repr=False, compare=False,
+    )
+
+    @property
+    def real_path(self) -> str:
+        if self.resolved_path is None:
+            assert self.resolver
+            self.resolved_path = self.resolver()
+        return self.resolved_path
+
+    def is_std(self) -> bool:
+        return self.include_line.rstrip().endswith('>') and (
+            self.orig_path in STD_HEADERS
+        )
 
 
 # Handle special symbols like quotes
@@ -59,8 +108,157 @@ def read_compile_commands(path: str) -> typing.Dict[str, CCEntry]:
     return compile_commands
 
 
+# Flags which change the header search paths
+INCLUDE_FLAGS_WITH_ARG = {
+    '-I',
+    '-isystem',
+    '-idirafter',
+    '-iquote',
+    '-isysroot',
+    '--sysroot',
+    '-iprefix',
+    '-iwithprefix',
+    '-iwithprefixbefore',
+    '-target',
+    '--gcc-toolchain',
+    '-B',
+}
+INCLUDE_FLAGS_PREFIXES = tuple(INCLUDE_FLAGS_WITH_ARG) + (
+    '--target=',
+    '-stdlib=',
+    '-nostdinc',
+    '-nostdlibinc',
+    '-m32',
+    '-m64',
+    '-mx32',
+)
+
+
+def extract_include_flags(
+        command_items: typing.List[str],
+) -> typing.Tuple[str, ...]:
+    result = command_items[:1]
+    i = 1
+    while i < len(command_items):
+        item = command_items[i]
+        if item in INCLUDE_FLAGS_WITH_ARG:
+            result += command_items[i : i + 2]
+            i += 2
+            continue
+        if item.startswith(INCLUDE_FLAGS_PREFIXES):
+            result.append(item)
+        i += 1
+    return tuple(result)
+
+
+# Flags with paths which must be fixed if the compiler is run
+# in another directory
+PATH_FLAGS_WITH_ARG = {
+    '-I',
+    '-isystem',
+    '-idirafter',
+    '-iquote',
+    '-isysroot',
+    '--sysroot',
+    '-iprefix',
+    '-include',
+    '-imacros',
+    '-B',
+}
+PATH_FLAGS_JOINED = (
+    '-isystem',
+    '-idirafter',
+    '-iquote',
+    '-I',
+    '-B',
+    '--sysroot=',
+)
+
+
+def absolutize_command_paths(
+        command_items: typing.List[str], base: str,
+) -> typing.List[str]:
+    compiler = command_items[0]
+    if '/' in compiler:
+        compiler = os.path.join(base, compiler)
+    result = [compiler]
+
+    i = 1
+    while i < len(command_items):
+        item = command_items[i]
+        if item in PATH_FLAGS_WITH_ARG and i + 1 < len(command_items):
+            result += [item, os.path.join(base, command_items[i + 1])]
+            i += 2
+            continue
+
+        for flag in PATH_FLAGS_JOINED:
+            if item.startswith(flag) and len(item) > len(flag):
+                item = flag + os.path.join(base, item[len(flag) :])
+                break
+        result.append(item)
+        i += 1
+    return result
+
+
+# Replaces @file arguments with the file contents. The paths inside are
+# relative to the compiler working directory and are fixed up later
+# along with the other flags.
+def expand_response_files(
+        command_items: typing.List[str], base: str,
+) -> typing.List[str]:
+    result = command_items[:1]
+    for item in command_items[1:]:
+        if not item.startswith('@'):
+            result.append(item)
+            continue
+
+        try:
+            contents = read_file_contents(os.path.join(base, item[1:]))
+        except OSError:
+            # The compiler keeps an unreadable @file as is
+            result.append(item)
+            continue
+        result += expand_response_files(
+            [''] + shlex.split(contents), base,
+        )[1:]
+    return result
+
+
+# Dependency file generation flags, the probes must not write anything
+DEPENDENCY_FLAGS = {'-M', '-MM', '-MD', '-MMD', '-MG', '-MP'}
+DEPENDENCY_FLAGS_WITH_ARG = ('-MF', '-MT', '-MQ', '-MJ')
+
+
+def drop_dependency_flags(
+        command_items: typing.List[str],
+) -> typing.List[str]:
+    result = []
+    i = 0
+    while i < len(command_items):
+        item = command_items[i]
+        if item in DEPENDENCY_FLAGS_WITH_ARG:
+            i += 2
+            continue
+        # -MF<file>, -Wp,-MD,<file>
+        if item in DEPENDENCY_FLAGS or item.startswith(
+            DEPENDENCY_FLAGS_WITH_ARG + ('-Wp,-MD,', '-Wp,-MMD,'),
+        ):
+            i += 1
+            continue
+        result.append(item)
+        i += 1
+    return result
+
+
+# Read the code from stdin
+STDIN_INPUT = ['-x', 'c++', '-']
+STDIN_NAME = '<stdin>'
+
+
 def adjust_cc_command(command: CCEntry) -> typing.List[str]:
-    command_items = command.command
+    command_items = drop_dependency_flags(
+        expand_response_files(command.command, os.getcwd()),
+    )
 
     # Read the code from stdin instead of <some>.cpp
     i = 0
@@ -90,6 +288,10 @@ def is_include(string: str) -> bool:
     return bool(re.match(r'^\s*#include ', string))
 
 
+def is_angle_include(string: str) -> bool:
+    return bool(re.match(r'^\s*#include\s*<', string))
+
+
 def is_include_or_empty(string: str) -> bool:
     return is_include(string) or not string.strip()
 
@@ -318,8 +520,13 @@ HEADERS_CXX = [
     'cuchar',
 ]
 
+STD_HEADERS = frozenset(HEADERS_C + HEADERS_CXX)
+
 
 class Matcher:
+    # Whether is_match() uses the real path of the header
+    needs_real_path = True
+
     def is_match(self, path: str, orig_path: str, my_filename: str) -> bool:
         raise NotImplementedError('abstract class')
 
@@ -333,6 +540,8 @@ class MatcherRe(Matcher):
 
 
 class MatcherHardcoded(Matcher):
+    needs_real_path = False
+
     def __init__(self, headers: typing.List[str]):
         self.allowed = set(headers)
 
@@ -341,6 +550,9 @@ class MatcherHardcoded(Matcher):
 
 
 class MatcherPairHeader(Matcher):
+    # The pair header is selected in advance
+    needs_real_path = False
+
     def is_match(self, path: str, orig_path: str, my_filename: str) -> bool:
         return False
 
@@ -384,6 +596,13 @@ def select_pair_header(
     scored_include = None
 
     for inc in includes:
+        # Don't resolve the path of obviously wrong candidates
+        if (
+                remove_extention(extract_fname(inc.orig_path))
+                != my_filename_wo_extention
+        ):
+            continue
+
         inc_parts = inc.real_path.split('/')
 
         min_len = min(len(inc_parts), len(my_filepath_parts))
@@ -410,7 +629,8 @@ def sort_includes(
 ) -> typing.List[typing.List[str]]:
     res: typing.List[typing.List[str]] = [[] for _ in config.rules]
 
-    if config.has_pair_header:
+    pair_header = None
+    if config.has_pair_header():
         pair_header = select_pair_header(includes, my_filename)
 
     for inc in includes:
@@ -424,9 +644,9 @@ def sort_includes(
                     if inc.orig_path == pair_header.orig_path:
                         match = True
                         break
-                match = matcher.is_match(
-                    inc.real_path, inc.orig_path, my_filename,
-                )
+                # Resolve the path only if the matcher needs it
+                path = inc.real_path if matcher.needs_real_path else ''
+                match = matcher.is_match(path, inc.orig_path, my_filename)
                 # The first match wins
                 if match:
                     break
@@ -460,38 +680,539 @@ def write_includes(
             ofile.write('\n')
 
 
+# The header can't be resolved with the given flags, e.g. it is missing.
+# Unlike timeouts or a crashed compiler, retrying won't help.
+class ResolutionError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class ResolutionFailure:
+    error: str
+    expires_at: float
+
+
+class RealpathCacheKey(typing.NamedTuple):
+    include_line: str
+    flags: typing.Any
+    # The directory of the including file, None if it doesn't matter
+    directory: typing.Optional[str]
+
+
+@dataclasses.dataclass
+class RealpathCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
 # The cache of a long 'cc ...' command output
-# dictionary: cmdline_string -> file path
+# dictionary: RealpathCacheKey -> file path
+#
+# Failures (ResolutionError) are cached for 'negative_ttl' seconds, other
+# errors are considered transient and are not cached. Concurrent lookups of the
+# same key are merged: the first caller resolves it, the rest wait for it.
+# The least recently used entries are evicted if the cache grows beyond
+# 'max_entries' or 'max_memory' bytes.
 class RealpathCache:
-    def __init__(self):
-        self.cache: dict = {}
+    DEFAULT_NEGATIVE_TTL = 600.0
+    # Approximate size of an entry without strings
+    ENTRY_OVERHEAD = 256
+
+    def __init__(
+            self,
+            negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+            max_entries: typing.Optional[int] = None,
+            max_memory: typing.Optional[int] = None,
+    ):
+        self.cache: collections.OrderedDict = collections.OrderedDict()
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.memory = 0
+        self.stats = RealpathCacheStats()
+        # flags -> the number of entries with them
+        self._flags_refs: typing.Dict[typing.Any, int] = {}
+        self._in_flight: typing.Dict[typing.Any, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _entry_size(
+            self,
+            key: RealpathCacheKey,
+            value: typing.Union[str, ResolutionFailure],
+    ) -> int:
+        if isinstance(value, ResolutionFailure):
+            value = value.error
+        return (
+            self.ENTRY_OVERHEAD
+            + len(key.include_line)
+            + len(key.directory or '')
+            + len(value)
+        )
+
+    # The flags are interned (see CCEntry.include_flags()) and are shared
+    # by many entries, so each flags tuple is counted once
+    @staticmethod
+    def _flags_size(flags: typing.Any) -> int:
+        if not flags:
+            return 0
+        return sys.getsizeof(flags) + sum(
+            sys.getsizeof(item) for item in flags
+        )
+
+    def _ref_flags(self, flags: typing.Any) -> None:
+        refs = self._flags_refs.get(flags, 0)
+        if not refs:
+            self.memory += self._flags_size(flags)
+        self._flags_refs[flags] = refs + 1
+
+    def _unref_flags(self, flags: typing.Any) -> None:
+        refs = self._flags_refs[flags] - 1
+        if refs:
+            self._flags_refs[flags] = refs
+        else:
+            del self._flags_refs[flags]
+            self.memory -= self._flags_size(flags)
+
+    def _pop(self, key: RealpathCacheKey) -> None:
+        value = self.cache.pop(key)
+        self.memory -= self._entry_size(key, value)
+        self._unref_flags(key.flags)
+
+    def _put(
+            self,
+            key: RealpathCacheKey,
+            value: typing.Union[str, ResolutionFailure],
+    ) -> None:
+        with self._lock:
+            if key in self.cache:
+                self._pop(key)
+            self.cache[key] = value
+            self.memory += self._entry_size(key, value)
+            self._ref_flags(key.flags)
+
+            while len(self.cache) > 1 and (
+                    (self.max_entries and len(self.cache) > self.max_entries)
+                    or (self.max_memory and self.memory > self.max_memory)
+            ):
+                self._pop(next(iter(self.cache)))
+                self.stats.evictions += 1
+
+    # Doesn't affect the eviction order and the stats
+    def find(self, key: RealpathCacheKey) -> typing.Optional[str]:
+        entry = self.cache.get(key)
+        if isinstance(entry, ResolutionFailure):
+            return None
+        return entry
+
+    def set(self, key: RealpathCacheKey, value: str) -> None:
+        self._put(key, value)
+
+    def set_failure(self, key: RealpathCacheKey, error: str) -> None:
+        self._put(
+            key,
+            ResolutionFailure(
+                error=error, expires_at=time.monotonic() + self.negative_ttl,
+            ),
+        )
+
+    def get_or_resolve(
+            self, key: RealpathCacheKey, resolve: typing.Callable[[], str],
+    ) -> str:
+        while True:
+            with self._lock:
+                entry = self.cache.get(key)
+                if isinstance(entry, ResolutionFailure):
+                    if entry.expires_at > time.monotonic():
+                        self.cache.move_to_end(key)
+                        self.stats.hits += 1
+                        raise ResolutionError(entry.error)
+                elif entry:
+                    self.cache.move_to_end(key)
+                    self.stats.hits += 1
+                    return entry
+
+                event = self._in_flight.get(key)
+                if not event:
+                    self.stats.misses += 1
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    break
+            event.wait()
+
+        try:
+            result = resolve()
+            self.set(key, result)
+            return result
+        except ResolutionError as exc:
+            self.set_failure(key, str(exc))
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def invalidate(
+            self,
+            predicate: typing.Callable[
+                [RealpathCacheKey, typing.Union[str, ResolutionFailure]], bool,
+            ],
+    ) -> int:
+        with self._lock:
+            keys = [
+                key
+                for key, value in self.cache.items()
+                if predicate(key, value)
+            ]
+            for key in keys:
+                self._pop(key)
+        return len(keys)
+
+    # Drops the entries resolved to 'path' and the entries which might be
+    # resolved to 'path' if it is created
+    def invalidate_file(self, path: str) -> int:
+        path = os.path.realpath(path)
+        directory, filename = os.path.split(path)
+
+        def predicate(key, value) -> bool:
+            if value == path:
+                return True
+            return key.directory == directory and extract_fname(
+                extract_file_relpath(key.include_line),
+            ) == filename
+
+        return self.invalidate(predicate)
+
+    def invalidate_directory(self, directory: str) -> int:
+        directory = os.path.realpath(directory)
+        prefix = directory.rstrip('/') + '/'
+
+        def is_inside(path: typing.Optional[str]) -> bool:
+            if not path:
+                return False
+            return path == directory or path.startswith(prefix)
+
+        return self.invalidate(
+            lambda key, value: is_inside(key.directory)
+            or (isinstance(value, str) and is_inside(value)),
+        )
+
+
+# The client side of GNU make jobserver protocol.
+# Each token read from the pipe allows to run one more job in parallel,
+# it must be written back after the job is finished.
+class JobServer:
+    def __init__(self, read_fd: int, write_fd: int):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+
+    @classmethod
+    def from_makeflags(cls, makeflags: str) -> typing.Optional['JobServer']:
+        auth = None
+        for flag in makeflags.split():
+            # --jobserver-fds is used by make < 4.2
+            for prefix in ('--jobserver-auth=', '--jobserver-fds='):
+                if flag.startswith(prefix):
+                    auth = flag[len(prefix) :]
+        if not auth:
+            return None
+
+        try:
+            if auth.startswith('fifo:'):
+                fd = os.open(auth[len('fifo:') :], os.O_RDWR)
+                return cls(fd, fd)
+
+            read_fd, write_fd = (int(fd) for fd in auth.split(','))
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except (OSError, ValueError) as exc:
+            # make doesn't pass the fds to recipes not marked with '+'
+            print(f'Warning: jobserver "{auth}" is unavailable ({exc})')
+            return None
+        return cls(read_fd, write_fd)
+
+    def acquire(self) -> bytes:
+        while True:
+            # make passes the read end with O_NONBLOCK set (make >= 4.3),
+            # so wait for a token. The file description is shared with
+            # make, so the flag must stay as it is.
+            select.select([self.read_fd], [], [])
+            try:
+                token = os.read(self.read_fd, 1)
+            except (BlockingIOError, InterruptedError):
+                # Another job took the token first
+                continue
+            if not token:
+                raise Exception('jobserver pipe is closed')
+            return token
+
+    def release(self, token: bytes) -> None:
+        os.write(self.write_fd, token)
 
-    def find(self, key: typing.Any) -> typing.Optional[str]:
-        return self.cache.get(key)
 
-    def set(self, key: typing.Any, value: str) -> None:
-        self.cache[key] = value
+def read_available_memory() -> typing.Optional[int]:
+    try:
+        with open('/proc/meminfo', 'r') as ifile:
+            for line in ifile:
+                if line.startswith('MemAvailable:'):
+                    # MemAvailable:   12345678 kB
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_load_average() -> typing.Optional[float]:
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+
+# Limits the number of compiler probes running simultaneously.
+# A probe is started only if there is a free jobserver token (if any)
+# and the machine is not overloaded. At least one probe is always allowed
+# to run, otherwise we might wait forever.
+class ProbeScheduler:
+    THROTTLE_INTERVAL = 0.1
+    # The token every process run by make owns implicitly
+    IMPLICIT_TOKEN = object()
+
+    def __init__(
+            self,
+            jobserver: typing.Optional[JobServer] = None,
+            max_load: typing.Optional[float] = None,
+            min_free_memory: typing.Optional[int] = None,
+            helper: typing.Optional[spawn_helper.SpawnHelper] = None,
+    ):
+        self.jobserver = jobserver
+        self.helper = helper
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.in_flight = 0
+        self.probes_started = 0
+        # probe id -> start time, for the running probes
+        self._running: typing.Dict[int, float] = {}
+        # The process owns a single implicit jobserver token
+        self._implicit_token_free = True
+        self._lock = threading.Lock()
+
+    def _is_overloaded(self) -> bool:
+        if self.max_load is not None:
+            load = read_load_average()
+            if load is not None and load > self.max_load:
+                return True
+        if self.min_free_memory is not None:
+            available = read_available_memory()
+            if available is not None and available < self.min_free_memory:
+                return True
+        return False
+
+    # Returns the taken token: a byte read from the jobserver,
+    # IMPLICIT_TOKEN or None if there is no jobserver
+    def _acquire_token(self) -> typing.Optional[object]:
+        if not self.jobserver:
+            # The concurrency is limited by the workers count only
+            return None
+        with self._lock:
+            if self._implicit_token_free:
+                self._implicit_token_free = False
+                return self.IMPLICIT_TOKEN
+        return self.jobserver.acquire()
+
+    def _release_token(self, token: typing.Optional[object]) -> None:
+        if token is self.IMPLICIT_TOKEN:
+            with self._lock:
+                self._implicit_token_free = True
+        elif token is not None:
+            self.jobserver.release(token)
+
+    @contextlib.contextmanager
+    def slot(self) -> typing.Iterator[None]:
+        while True:
+            with self._lock:
+                if not self.in_flight or not self._is_overloaded():
+                    self.in_flight += 1
+                    break
+            time.sleep(self.THROTTLE_INTERVAL)
+
+        # Nothing to release if acquiring the token fails
+        token = None
+        probe_id = None
+        try:
+            token = self._acquire_token()
+            with self._lock:
+                probe_id = self.probes_started
+                self.probes_started += 1
+                self._running[probe_id] = time.monotonic()
+            yield
+        finally:
+            self._release_token(token)
+            with self._lock:
+                self.in_flight -= 1
+                self._running.pop(probe_id, None)
+
+    # For how long the oldest running probe is running (in seconds)
+    def oldest_probe_age(self) -> float:
+        with self._lock:
+            if not self._running:
+                return 0.0
+            return time.monotonic() - min(self._running.values())
+
+    def run(
+            self,
+            command_items: typing.List[str],
+            input_data: typing.Optional[bytes] = None,
+            timeout: float = 10,
+            cwd: typing.Optional[str] = None,
+    ) -> typing.Tuple[int, bytes, bytes]:
+        with self.slot():
+            if self.helper:
+                return self.helper.run(command_items, input_data, timeout, cwd)
+
+            with subprocess.Popen(
+                    command_items,
+                    cwd=cwd,
+                    stdin=(
+                        subprocess.PIPE
+                        if input_data is not None
+                        else subprocess.DEVNULL
+                    ),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+            ) as proc:
+                try:
+                    out, err = proc.communicate(input_data, timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    raise
+                return proc.returncode, out, err
+
+
+# The header path depends on the header search flags and, for quoted
+# includes, on the directory of the including file
+def realpath_cache_key(
+        filepath: str,
+        source_filepath: str,
+        include_line: str,
+        compile_commands: typing.Dict[str, CCEntry],
+) -> RealpathCacheKey:
+    command = compile_commands.get(os.path.abspath(source_filepath))
+    if is_angle_include(include_line):
+        directory = None
+    else:
+        directory = os.path.dirname(os.path.abspath(filepath))
+    return RealpathCacheKey(
+        include_line=include_line,
+        flags=command.include_flags() if command else None,
+        directory=directory,
+    )
 
 
-# Returns the absolute path of a header from 'include_line'
+# The headers included by other headers as seen in the compiler output:
+# (header search flags, header) -> {#include line number: included header}
+#
+# An #include is matched by its position, as the spelling can't tell which
+# header is entered: "x.hpp" may be found via -I/include/other. The headers
+# skipped due to '#pragma once' or include guards are not entered at all,
+# such #include lines have no entry. The least recently used headers are
+# dropped beyond 'max_headers'.
+class IncludeTree:
+    DEFAULT_MAX_HEADERS = 16384
+
+    def __init__(self, max_headers: int = DEFAULT_MAX_HEADERS):
+        self.data: collections.OrderedDict = collections.OrderedDict()
+        self.max_headers = max_headers
+        self._lock = threading.Lock()
+
+    # 'directory' is the compiler working directory
+    def add_output(self, flags: typing.Any, out: str, directory: str) -> None:
+        realpaths: typing.Dict[str, str] = {}
+
+        def realpath(path: str) -> str:
+            if path not in realpaths:
+                realpaths[path] = os.path.realpath(
+                    os.path.join(directory, path),
+                )
+            return realpaths[path]
+
+        # (header, line number) -> included header
+        edges: typing.Dict[typing.Tuple[str, int], str] = {}
+        # The entered files
+        stack: typing.List[str] = []
+        for line in out.split('\n'):
+            match = LINEMARKER_RE.match(line)
+            if not match:
+                continue
+
+            path = re.sub(r'\\(.)', r'\1', match.group(1))
+            line_flags = match.group(2).split()
+            if '1' in line_flags:
+                stack.append(path)
+            elif '2' in line_flags and stack:
+                child = stack.pop()
+                # The line after the #include is reported on return.
+                # System headers are never handled, skip their includes.
+                if not path.startswith('<') and '3' not in line_flags:
+                    line_number = int(line.split()[1]) - 1
+                    edges[(realpath(path), line_number)] = realpath(child)
+
+        with self._lock:
+            for (header, line_number), child in edges.items():
+                key = (flags, header)
+                entries = self.data.setdefault(key, {})
+                self.data.move_to_end(key)
+                known = entries.setdefault(line_number, child)
+                if known is not None and known != child:
+                    # The header was changed in between, don't guess
+                    entries[line_number] = None
+
+            while len(self.data) > self.max_headers:
+                self.data.popitem(last=False)
+
+    # Returns the header included by 'header' at 'line_number' if it is known
+    def find(
+            self, flags: typing.Any, header: str, line_number: int,
+    ) -> typing.Optional[str]:
+        with self._lock:
+            entries = self.data.get((flags, header))
+            if not entries:
+                return None
+            self.data.move_to_end((flags, header))
+            return entries.get(line_number)
+
+
+# Returns the absolute path of a header from 'include_line'.
+# 'line_number' is the line of 'include_line' in 'filepath' (from 1).
 def include_realpath_cached(
         filepath: str,
         source_filepath: str,
         include_line: str,
         compile_commands: typing.Dict[str, CCEntry],
         realpath_cache: RealpathCache,
+        scheduler: ProbeScheduler,
+        include_tree: IncludeTree,
+        line_number: typing.Optional[int] = None,
 ) -> str:
-    directory = os.path.dirname(source_filepath)
-
-    key = (include_line, ' '.join(compile_commands), directory)
-    entry = realpath_cache.find(key)
-    if entry:
-        return entry
-
-    result = include_realpath(filepath, source_filepath, include_line, compile_commands)
-    if result:
-        realpath_cache.set(key, result)
-    return result
+    key = realpath_cache_key(
+        filepath, source_filepath, include_line, compile_commands,
+    )
+    return realpath_cache.get_or_resolve(
+        key,
+        lambda: include_realpath(
+            filepath,
+            source_filepath,
+            include_line,
+            compile_commands,
+            scheduler,
+            include_tree,
+            line_number,
+        ),
+    )
 
 
 def include_realpath(
@@ -499,61 +1220,238 @@ def include_realpath(
         source_filepath: str,
         include_line: str,
         compile_commands: typing.Dict[str, CCEntry],
+        scheduler: ProbeScheduler,
+        include_tree: IncludeTree,
+        line_number: typing.Optional[int] = None,
 ) -> str:
     filepath = os.path.abspath(filepath)
     source_filepath = os.path.abspath(source_filepath)
 
-    directory = os.path.dirname(filepath)
-    tmp = tempfile.NamedTemporaryFile(suffix='.cpp', dir=directory)
-    tmp_name = tmp.name
-    tmp.write(include_line.encode())
-    tmp.write('\n'.encode())
-    tmp.flush()
-
     command = compile_commands.get(source_filepath)
     if not command:
         raise Exception(
             f'Failed to find "{source_filepath}" in compile_commands.json',
         )
-    command_items = adjust_cc_command(command) + [tmp_name]
-
-    tmp2 = open(tmp_name)
-    with subprocess.Popen(
-            command_items,
-            stdin=tmp2,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-    ) as proc:
-        out, err = proc.communicate(timeout=10)
-        return_code = proc.returncode
-        if return_code != 0:
-            sys.stderr.write(err.decode('utf-8'))
-            raise Exception('Compilation attempt failed, see stderr')
-
-        result = None
-        for line in out.decode('utf-8').split('\n'):
-            if not line.startswith('#'):
-                continue
 
-            if '/' not in line or tmp_name in line:
-                continue
+    # A header is likely to be seen already while probing its .cpp
+    if line_number is not None:
+        result = include_tree.find(
+            command.include_flags(), os.path.realpath(filepath), line_number,
+        )
+        if result:
+            return result
 
-            # The first line with '/' is our file's full path.
-            # Example:
-            # 1 "/home/segoon/projects/taxi/userver/submodules/googletest/googletest/include/gtest/gtest.h" 1 3
-            line = line.split('"', 2)[1]
-            line = os.path.realpath(line)
-            if result is None:
-                result = line
-                proc.kill()
-                return result
-
-    raise Exception(
+    # The code is read from stdin. For stdin the compiler looks for quoted
+    # includes in the current directory first, so the compiler is run in
+    # the directory of our file.
+    directory = os.path.dirname(filepath)
+    command_items = absolutize_command_paths(
+        adjust_cc_command(command), os.getcwd(),
+    ) + STDIN_INPUT
+    return_code, out, err = scheduler.run(
+        command_items, (include_line + '\n').encode(), cwd=directory,
+    )
+    if return_code != 0:
+        sys.stderr.write(err.decode('utf-8'))
+        if return_code < 0:
+            # Killed by a signal, e.g. by the OOM killer
+            raise Exception(f'Compiler is killed by signal {-return_code}')
+        raise ResolutionError('Compilation attempt failed, see stderr')
+
+    out_str = out.decode('utf-8')
+    include_tree.add_output(command.include_flags(), out_str, directory)
+    for parent, child, _ in iterate_includes(out_str):
+        # The first file included from our file.
+        # Example:
+        # 1 "/home/segoon/projects/taxi/userver/submodules/googletest/googletest/include/gtest/gtest.h" 1 3
+        if parent == STDIN_NAME and child:
+            return os.path.realpath(os.path.join(directory, child))
+
+    raise ResolutionError(
         f'Header not found ({include_line}), '
         f'broken compile_commands.json?',
     )
 
 
+LINEMARKER_RE = re.compile(r'^# \d+ "((?:[^"\\]|\\.)*)"((?: \d+)*)$')
+
+
+# Parses the output of 'cc -E'. Yields (including file, included file, line)
+# for every entered header and (current file, None, line) for other lines.
+def iterate_includes(
+        out: str,
+) -> typing.Iterator[typing.Tuple[str, typing.Optional[str], str]]:
+    current = ''
+    for line in out.split('\n'):
+        match = LINEMARKER_RE.match(line)
+        if not match:
+            yield current, None, line
+            continue
+
+        path = re.sub(r'\\(.)', r'\1', match.group(1))
+        flags = match.group(2).split()
+        # '1' means entering a new file, '2' means returning to a file
+        if '1' in flags:
+            yield current, path, line
+        current = path
+
+
+BATCH_MARKER = 'SORT_CPP_INCLUDES_BATCH_'
+
+
+# Resolves many angle bracket includes with a single compiler run.
+# Returns include line -> header path, missing headers are skipped.
+def include_realpath_batch(
+        command: CCEntry,
+        include_lines: typing.List[str],
+        scheduler: ProbeScheduler,
+        include_tree: IncludeTree,
+) -> typing.Dict[str, str]:
+    code = io.StringIO()
+    for i, line in enumerate(include_lines):
+        # A missing header must not break the whole batch
+        spelling = extract_file_relpath(line)
+        code.write(
+            f'#if __has_include(<{spelling}>)\n'
+            f'{BATCH_MARKER}{i}\n'
+            f'{line}\n'
+            f'#endif\n',
+        )
+
+    command_items = adjust_cc_command(command) + STDIN_INPUT
+    return_code, out, _ = scheduler.run(
+        command_items, code.getvalue().encode(), timeout=60,
+    )
+    if return_code != 0:
+        return {}
+
+    out_str = out.decode('utf-8')
+    include_tree.add_output(command.include_flags(), out_str, os.getcwd())
+    result = {}
+    index = None
+    for parent, child, line in iterate_includes(out_str):
+        if parent != STDIN_NAME:
+            continue
+        if child is None:
+            if line.startswith(BATCH_MARKER):
+                index = int(line[len(BATCH_MARKER) :])
+        elif index is not None:
+            # A header already included with another spelling is not
+            # entered again, such lines are left for the per-file pass
+            result[include_lines[index]] = os.path.realpath(child)
+            index = None
+    return result
+
+
+# Angle bracket includes depend on the header search flags only,
+# so they are resolved in advance with a compiler run per flags set.
+# Source files are added as they are discovered, a batch is sent as soon
+# as it is full, so the files handling doesn't wait for the discovery end.
+class AngleIncludePrefetcher:
+    BATCH_SIZE = 256
+
+    def __init__(
+            self,
+            compile_commands: typing.Dict[str, CCEntry],
+            realpath_cache: RealpathCache,
+            scheduler: ProbeScheduler,
+            include_tree: IncludeTree,
+            budget: 'TimeBudget',
+            jobs: int,
+    ):
+        self.compile_commands = compile_commands
+        self.realpath_cache = realpath_cache
+        self.scheduler = scheduler
+        self.include_tree = include_tree
+        self.budget = budget
+        # The number of compiler runs made
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs,
+        )
+        # flags -> (command, include lines for the next batch)
+        self._groups: typing.Dict[
+            typing.Tuple[str, ...], typing.Tuple[CCEntry, typing.Set[str]],
+        ] = {}
+        # flags -> include lines already added
+        self._seen: typing.Dict[typing.Tuple[str, ...], typing.Set[str]] = {}
+        self._closed = False
+
+    # Called from a single thread
+    def add(self, source: str, include_lines: typing.List[str]) -> None:
+        command = self.compile_commands.get(os.path.abspath(source))
+        if not command:
+            return
+
+        flags = command.include_flags()
+        seen = self._seen.setdefault(flags, set())
+        _, pending = self._groups.setdefault(flags, (command, set()))
+        for line in include_lines:
+            if not is_angle_include(line) or line in seen:
+                continue
+            seen.add(line)
+
+            include = Include(
+                include_line=line, orig_path=extract_file_relpath(line),
+            )
+            # Standard headers are rarely resolved at all
+            if include.is_std():
+                continue
+            key = RealpathCacheKey(
+                include_line=line, flags=flags, directory=None,
+            )
+            if self.realpath_cache.find(key) is not None:
+                continue
+
+            pending.add(line)
+            if len(pending) >= self.BATCH_SIZE:
+                self._submit(flags)
+                _, pending = self._groups.setdefault(flags, (command, set()))
+
+    def _submit(self, flags: typing.Tuple[str, ...]) -> None:
+        command, lines = self._groups.pop(flags)
+        if lines:
+            self._executor.submit(self._resolve, command, sorted(lines))
+
+    # Sends the incomplete batches
+    def flush(self) -> None:
+        for flags in list(self._groups):
+            self._submit(flags)
+
+    def _resolve(self, command: CCEntry, lines: typing.List[str]) -> None:
+        # The includes will be resolved one by one if needed
+        if self._closed or not self.budget.allows_dispatch():
+            return
+
+        try:
+            resolved = include_realpath_batch(
+                command, lines, self.scheduler, self.include_tree,
+            )
+        except Exception as exc:
+            print(f'Failed to resolve includes in a batch ({exc})')
+            return
+        with self._lock:
+            self.batches += 1
+        for line, path in resolved.items():
+            self.realpath_cache.set(
+                RealpathCacheKey(
+                    include_line=line,
+                    flags=command.include_flags(),
+                    directory=None,
+                ),
+                path,
+            )
+
+    def wait(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    # Drops the batches which are not started yet
+    def close(self) -> None:
+        self._closed = True
+        self.wait()
+
+
 class Config:
     def __init__(self, contents: dict):
         rules_matrix = contents['rules']
@@ -577,9 +1475,13 @@ class Config:
                         raise Exception(f'Unknown "virtual: {vname}')
                 else:
                     raise Exception(f'Unknown matcher type: {rule}')
+            # Any matcher of the group gives the same result, so the matchers
+            # which don't need the header path resolution go first
+            out.sort(key=lambda matcher: matcher.needs_real_path)
             result.append(out)
 
         self.rules = result
+        self.rules_matrix = rules_matrix
         self._has_pair_header = has_pair_header
 
     def has_pair_header(self) -> bool:
@@ -590,10 +1492,51 @@ def is_pragma_once(line: str) -> bool:
     return line.strip() == '#pragma once'
 
 
+# Returns (whether there is '#pragma once', include lines, the index of
+# the first line after the includes)
+def parse_head(
+        lines: typing.List[str],
+) -> typing.Tuple[bool, typing.List[str], int]:
+    has_pragma_once = False
+    include_lines = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+
+        if is_pragma_once(line):
+            has_pragma_once = True
+            continue
+
+        if not is_include_or_empty(line):
+            return has_pragma_once, include_lines, i
+
+        if line:
+            include_lines.append(line)
+    return has_pragma_once, include_lines, len(lines)
+
+
+def render_head(
+        has_pragma_once: bool, sorted_includes: typing.List[typing.List[str]],
+) -> str:
+    ofile = io.StringIO()
+    if has_pragma_once:
+        ofile.write('#pragma once\n\n')
+    write_includes(sorted_includes, ofile)
+    return ofile.getvalue()
+
+
 @dataclasses.dataclass
 class IncludeMap:
     # .hpp -> .cpp
     data: typing.Dict[str, str]
+    # Called for every newly added .hpp
+    listener: typing.Optional[typing.Callable[[str], None]] = None
+
+    def add(self, header: str, source: str) -> None:
+        if header in self.data:
+            return
+        self.data[header] = source
+        if self.listener:
+            self.listener(header)
 
 
 def handle_single_file(
@@ -602,22 +1545,33 @@ def handle_single_file(
         compile_commands: dict,
         args: int,
         realpath_cache: RealpathCache,
+        scheduler: ProbeScheduler,
+        include_tree: IncludeTree,
         config: Config,
-        include_map: IncludeMap,
-) -> None:
+        include_map: typing.Optional[IncludeMap],
+        snapshot: typing.Optional['ResolutionSnapshot'] = None,
+        progress: typing.Optional['Progress'] = None,
+) -> typing.Optional[str]:
+    log = progress.log if progress else print
     try:
-        print(f'handling file {filepath}...')
-        do_handle_single_file(
+        # A line per file would break the progress bar
+        if not (progress and progress.bar):
+            log(f'handling file {filepath}...')
+        return do_handle_single_file(
             filepath,
             filepath_for_cc,
             compile_commands,
             args,
             realpath_cache,
+            scheduler,
+            include_tree,
             config,
             include_map,
+            snapshot,
         )
     except Exception as exc:
-        print(f'Failed to process "{filepath}", skipping (the error: {exc})')
+        log(f'Failed to process "{filepath}", skipping (the error: {exc})')
+        return None
 
 
 def do_handle_single_file(
@@ -626,60 +1580,155 @@ def do_handle_single_file(
         compile_commands: dict,
         args: int,
         realpath_cache: RealpathCache,
+        scheduler: ProbeScheduler,
+        include_tree: IncludeTree,
         config: Config,
-        include_map: IncludeMap,
-) -> None:
+        include_map: typing.Optional[IncludeMap],
+        snapshot: typing.Optional['ResolutionSnapshot'],
+) -> typing.Optional[str]:
     orig_file_contents = read_file_contents(filename).split('\n')
     if not orig_file_contents[-1]:
         orig_file_contents = orig_file_contents[:-1]
 
     assert orig_file_contents
 
-    i = -1  # for pylint
-    has_pragma_once = False
+    has_pragma_once, include_lines, head_end = parse_head(orig_file_contents)
+    # A repeated #include is not entered again, the first one matters
+    line_numbers: typing.Dict[str, int] = {}
+    for i, line in enumerate(orig_file_contents[:head_end]):
+        line_numbers.setdefault(line.strip(), i + 1)
+
     includes = []
-    for i, line in enumerate(orig_file_contents):
-        line = line.strip()
+    for line in include_lines:
 
-        if is_pragma_once(line):
-            has_pragma_once = True
-            continue
+        def resolve(line: str = line) -> str:
+            return include_realpath_cached(
+                filename,
+                filename_for_cc,
+                line,
+                compile_commands,
+                realpath_cache,
+                scheduler,
+                include_tree,
+                line_numbers[line],
+            )
 
-        if not is_include_or_empty(line):
-            break
+        orig_path = extract_file_relpath(line)
+        includes.append(
+            Include(include_line=line, orig_path=orig_path, resolver=resolve),
+        )
 
-        if not line.strip():
-            continue
-        abs_include = include_realpath_cached(
+    if snapshot is not None:
+        # The snapshot must be usable with any rules, resolve everything
+        snapshot.add(
             filename,
-            filename_for_cc, line, compile_commands, realpath_cache,
+            orig_file_contents[:head_end],
+            {inc.include_line: inc.real_path for inc in includes},
         )
+        sorted_includes = None
+    else:
+        sorted_includes = sort_includes(includes, filename, config)
 
-        orig_path = extract_file_relpath(line)
-        includes.append(
-            Include(
-                include_line=line, orig_path=orig_path, real_path=abs_include,
-            ),
-        )
-        if abs_include not in include_map.data:
-            include_map.data[abs_include] = filename
+    if include_map is not None:
+        for inc in includes:
+            # Standard headers are never handled, so there is no need
+            # to resolve them just for the map
+            if inc.resolved_path is None and inc.is_std():
+                continue
+            include_map.add(inc.real_path, filename)
 
-    assert i != -1
+    if sorted_includes is None:
+        return None
 
-    sorted_includes = sort_includes(includes, filename, config)
+    ofile = io.StringIO()
+    ofile.write(render_head(has_pragma_once, sorted_includes))
+    for line in orig_file_contents[head_end:]:
+        ofile.write(line)
+        ofile.write('\n')
+    return ofile.getvalue()
 
+
+def write_file_contents(filename: str, contents: str) -> None:
     tmp_filename = filename + '.tmp'
     with open(tmp_filename, 'w') as ofile:
-        if has_pragma_once:
-            ofile.write('#pragma once\n\n')
-        write_includes(sorted_includes, ofile)
-
-        for line in orig_file_contents[i + 1 :]:
-            ofile.write(line)
-            ofile.write('\n')
+        ofile.write(contents)
     os.rename(src=tmp_filename, dst=filename)
 
 
+# The resolved includes of every handled file, one JSON object per line.
+# The rules may be applied to it later without the compiler, see replay().
+class ResolutionSnapshot:
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self._ofile = open(path, 'w')
+        self._lock = threading.Lock()
+        self._write({'version': self.VERSION})
+
+    def _write(self, obj: dict) -> None:
+        self._ofile.write(json.dumps(obj, separators=(',', ':')))
+        self._ofile.write('\n')
+
+    def add(
+            self,
+            filename: str,
+            head: typing.List[str],
+            resolved: typing.Dict[str, str],
+    ) -> None:
+        with self._lock:
+            self._write({'file': filename, 'head': head, 'resolved': resolved})
+
+    def close(self) -> None:
+        self._ofile.close()
+
+
+def read_resolution_snapshot(path: str) -> typing.Iterator[dict]:
+    with open(path, 'r') as ifile:
+        header = json.loads(ifile.readline())
+        if header.get('version') != ResolutionSnapshot.VERSION:
+            raise Exception(f'Unsupported snapshot version: {header}')
+        for line in ifile:
+            yield json.loads(line)
+
+
+# Applies the rules to the snapshot, reports the number of includes
+# matched by each rule and the files which would be changed
+def replay(path: str, config: Config) -> None:
+    hits = [0 for _ in config.rules]
+    changed = []
+    for entry in read_resolution_snapshot(path):
+        filename = entry['file']
+        head = entry['head']
+        has_pragma_once, include_lines, _ = parse_head(head)
+        includes = [
+            Include(
+                include_line=line,
+                orig_path=extract_file_relpath(line),
+                resolved_path=entry['resolved'][line],
+            )
+            for line in include_lines
+        ]
+        try:
+            sorted_includes = sort_includes(includes, filename, config)
+        except Exception as exc:
+            print(f'Failed to process "{filename}" (the error: {exc})')
+            continue
+
+        for i, group in enumerate(sorted_includes):
+            hits[i] += len(group)
+        if render_head(has_pragma_once, sorted_includes) != ''.join(
+                line + '\n' for line in head
+        ):
+            changed.append(filename)
+
+    print('Includes matched by rules:')
+    for i, rule in enumerate(config.rules_matrix):
+        print(f'  #{i} {json.dumps(rule["matchers"])}: {hits[i]}')
+    print(f'{len(changed)} files would be changed:')
+    for filename in changed:
+        print(f'  {filename}')
+
+
 def read_config(filepath: typing.Optional[str]) -> Config:
     if not filepath:
         print('loaded default rule set')
@@ -691,30 +1740,806 @@ def read_config(filepath: typing.Optional[str]) -> Config:
         return Config(contents)
 
 
-def collect_files(
-        root: str, suffixes: typing.List[str],
-) -> typing.Iterable[str]:
-    for dirpath, _, files in os.walk(root):
-        for file in files:
-            for suffix in suffixes:
-                if file.endswith(suffix):
-                    yield os.path.join(dirpath, file)
-                    break
+def gitignore_pattern_to_regex(pattern: str) -> str:
+    # A pattern with a slash in the beginning or the middle is relative to
+    # the .gitignore directory, otherwise it matches at any level
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
 
+    result = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            result += '/.*'
+            i += 3
+        elif pattern[i] == '*':
+            result += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            result += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1 :]:
+            end = pattern.index(']', i + 1)
+            result += '[' + pattern[i + 1 : end].replace('!', '^', 1) + ']'
+            i = end + 1
+        else:
+            result += re.escape(pattern[i])
+            i += 1
+
+    if not anchored:
+        result = '(?:.*/)?' + result
+    return result
 
-def collect_all_files(
-        paths: typing.List[str], suffixes: typing.List[str],
-) -> typing.List[str]:
-    print('Collecting input files...')
-    headers = []
+
+# The patterns of a single ignore file. All the patterns are combined into
+# a single regex, the alternatives are in the reverse order as the last
+# matching pattern wins.
+class IgnoreFile:
+    def __init__(
+            self, patterns: typing.List[typing.Tuple[str, bool, bool]],
+    ):
+        # (regex, negate, dir_only) for every pattern
+        self._dir_regex, self._dir_negate = self._compile(patterns)
+        self._file_regex, self._file_negate = self._compile(
+            [pattern for pattern in patterns if not pattern[2]],
+        )
+
+    @staticmethod
+    def _compile(
+            patterns: typing.List[typing.Tuple[str, bool, bool]],
+    ) -> typing.Tuple[typing.Optional[typing.Pattern], typing.List[bool]]:
+        if not patterns:
+            return None, []
+        patterns = patterns[::-1]
+        # The patterns have no capturing groups of their own
+        regex = re.compile('|'.join(f'({regex})' for regex, _, _ in patterns))
+        # The group index -> negate
+        return regex, [False] + [negate for _, negate, _ in patterns]
+
+    def __bool__(self) -> bool:
+        return self._dir_regex is not None
+
+    # 'relpath' is relative to the ignore file directory.
+    # Returns None if no pattern matches, otherwise whether it is ignored.
+    def match(self, relpath: str, is_dir: bool) -> typing.Optional[bool]:
+        if is_dir:
+            regex, negate = self._dir_regex, self._dir_negate
+        else:
+            regex, negate = self._file_regex, self._file_negate
+        if regex is None:
+            return None
+        match = regex.fullmatch(relpath)
+        if not match:
+            return None
+        return not negate[match.lastindex]
+
+
+# An ignore file with the path of the scanned directory relative to the
+# ignore file directory ('' or ending with '/')
+IgnoreScope = typing.Tuple[IgnoreFile, str]
+
+
+def read_gitignore(directory: str) -> IgnoreFile:
+    return read_ignore_file(os.path.join(directory, '.gitignore'))
+
+
+def read_ignore_file(path: str) -> IgnoreFile:
+    try:
+        contents = read_file_contents(path)
+    except OSError:
+        return IgnoreFile([])
+
+    patterns = []
+    for line in contents.split('\n'):
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+
+        patterns.append((gitignore_pattern_to_regex(line), negate, dir_only))
+    return IgnoreFile(patterns)
+
+
+# Returns the ignore files which apply to 'directory' but are defined outside
+# of it: the global excludes, .git/info/exclude and .gitignore files of the
+# parent directories up to the git working tree root, in the order of
+# precedence
+def read_parent_ignore_files(directory: str) -> typing.List[IgnoreScope]:
+    try:
+        out = subprocess.check_output(
+            [
+                'git',
+                '-C',
+                directory,
+                'rev-parse',
+                '--show-toplevel',
+                '--git-path',
+                'info/exclude',
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    toplevel, info_exclude = out.decode('utf-8').strip().split('\n')
+    toplevel = os.path.realpath(toplevel)
+
+    try:
+        excludes_file = (
+            subprocess.check_output(
+                [
+                    'git',
+                    '-C',
+                    directory,
+                    'config',
+                    '--path',
+                    'core.excludesFile',
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode('utf-8')
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser(
+            '~/.config',
+        )
+        excludes_file = os.path.join(config_home, 'git', 'ignore')
+
+    directory = os.path.realpath(directory)
+
+    def relative_to(base: str) -> str:
+        relpath = os.path.relpath(directory, base)
+        return '' if relpath == '.' else relpath + '/'
+
+    scopes = [
+        (read_ignore_file(excludes_file), relative_to(toplevel)),
+        (
+            read_ignore_file(os.path.join(directory, info_exclude)),
+            relative_to(toplevel),
+        ),
+    ]
+
+    # The directory itself is read by FileFilter.scan_directory()
+    parents = []
+    parent = directory
+    while parent.startswith(toplevel + '/'):
+        parent = os.path.dirname(parent)
+        parents.append(parent)
+    for parent in reversed(parents):
+        scopes.append((read_gitignore(parent), relative_to(parent)))
+    return [scope for scope in scopes if scope[0]]
+
+
+class FileFilter:
+    def __init__(
+            self,
+            suffixes: typing.List[str],
+            excludes: typing.Sequence[str],
+            use_gitignore: bool,
+    ):
+        # A single regex is much faster than a loop over suffixes
+        self.suffix_regex = re.compile(
+            '(?:' + '|'.join(re.escape(suffix) for suffix in suffixes) + ')$',
+        )
+        self.exclude_regex = (
+            re.compile(
+                '|'.join(fnmatch.translate(exclude) for exclude in excludes),
+            )
+            if excludes
+            else None
+        )
+        self.use_gitignore = use_gitignore
+
+    def is_excluded(
+            self,
+            path: str,
+            name: str,
+            is_dir: bool,
+            ignore_scopes: typing.Sequence[IgnoreScope],
+    ) -> bool:
+        if is_dir and name == '.git':
+            return True
+        if self.exclude_regex and (
+                self.exclude_regex.match(name) or self.exclude_regex.match(path)
+        ):
+            return True
+
+        # The deepest ignore file with a matching pattern wins
+        for ignore_file, prefix in reversed(ignore_scopes):
+            ignored = ignore_file.match(prefix + name, is_dir)
+            if ignored is not None:
+                return ignored
+        return False
+
+    def scan_directory(
+            self,
+            directory: str,
+            parent_scopes: typing.Tuple[IgnoreScope, ...],
+    ) -> typing.Tuple[
+            typing.List[str],
+            typing.List[typing.Tuple[str, typing.Tuple[IgnoreScope, ...]]],
+    ]:
+        scopes = parent_scopes
+        if self.use_gitignore:
+            gitignore = read_gitignore(directory)
+            if gitignore:
+                scopes += ((gitignore, ''),)
+
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if self.is_excluded(
+                            entry.path, entry.name, is_dir, scopes,
+                    ):
+                        continue
+
+                    if is_dir:
+                        # The relative paths are extended by a prefix,
+                        # os.path.relpath() is too slow for every entry
+                        subdirs.append(
+                            (
+                                entry.path,
+                                tuple(
+                                    (ignore_file, prefix + entry.name + '/')
+                                    for ignore_file, prefix in scopes
+                                ),
+                            ),
+                        )
+                    elif self.suffix_regex.search(entry.name):
+                        files.append(entry.path)
+        except OSError as exc:
+            print(f'Failed to read directory "{directory}" ({exc})')
+        return files, subdirs
+
+
+# Traverses directories in 'jobs' threads, files are yielded
+# as soon as their directory is read
+def collect_files(
+        root: str, file_filter: FileFilter, jobs: int = 1,
+) -> typing.Iterable[str]:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        parent_scopes: typing.Tuple[IgnoreScope, ...] = ()
+        if file_filter.use_gitignore:
+            parent_scopes = tuple(read_parent_ignore_files(root))
+        in_flight = {
+            executor.submit(file_filter.scan_directory, root, parent_scopes),
+        }
+        while in_flight:
+            done, in_flight = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                files, subdirs = future.result()
+                for directory, scopes in subdirs:
+                    in_flight.add(
+                        executor.submit(
+                            file_filter.scan_directory, directory, scopes,
+                        ),
+                    )
+                yield from files
+
+
+def discover_files(
+        paths: typing.List[str], file_filter: FileFilter, jobs: int = 1,
+) -> typing.Iterable[str]:
     for filepath in paths:
         if os.path.isfile(filepath):
-            headers.append(filepath)
+            yield filepath
         elif os.path.isdir(filepath):
-            for header in collect_files(filepath, suffixes):
-                headers.append(header)
-    print(f'Collected files.')
-    return headers
+            yield from collect_files(filepath, file_filter, jobs)
+
+
+# Reads only the head of the file
+def read_include_lines(filepath: str) -> typing.List[str]:
+    head = []
+    try:
+        with open(filepath, 'r') as ifile:
+            for line in ifile:
+                line = line.rstrip('\n')
+                head.append(line)
+                stripped = line.strip()
+                if not is_pragma_once(stripped) and not is_include_or_empty(
+                        stripped,
+                ):
+                    break
+    except OSError:
+        return []
+
+    _, include_lines, _ = parse_head(head)
+    return include_lines
+
+
+# Returns the files modified in git working trees of 'paths'
+def collect_changed_files(paths: typing.List[str]) -> typing.Set[str]:
+    toplevels = set()
+    for path in paths:
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        try:
+            toplevel = subprocess.check_output(
+                ['git', '-C', directory or '.', 'rev-parse', '--show-toplevel'],
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        toplevels.add(toplevel.decode('utf-8').strip())
+
+    result = set()
+    for toplevel in toplevels:
+        for command in (
+                ['diff', '--name-only', 'HEAD'],
+                ['ls-files', '--others', '--exclude-standard'],
+        ):
+            try:
+                out = subprocess.check_output(
+                    ['git', '-C', toplevel] + command,
+                    stderr=subprocess.DEVNULL,
+                )
+            except (OSError, subprocess.CalledProcessError):
+                continue
+            for line in out.decode('utf-8').split('\n'):
+                if line:
+                    result.add(os.path.realpath(os.path.join(toplevel, line)))
+    return result
+
+
+@dataclasses.dataclass
+class WorkItem:
+    filepath: str
+    filepath_for_cc: str
+    include_lines: typing.List[str]
+    changed: bool
+
+
+class TimeBudget:
+    def __init__(self, seconds: typing.Optional[float]):
+        self.deadline = (
+            time.monotonic() + seconds if seconds is not None else None
+        )
+        self._total_duration = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, duration: float) -> None:
+        with self._lock:
+            self._total_duration += duration
+            self._count += 1
+
+    # A new file is dispatched only if it is expected to be finished
+    # before the deadline
+    def allows_dispatch(self) -> bool:
+        if self.deadline is None:
+            return True
+
+        with self._lock:
+            expected = self._total_duration / self._count if self._count else 0
+        return time.monotonic() + expected < self.deadline
+
+
+# Changed files first, then files with cache-warm includes,
+# then the most expensive files. Lower is better.
+def work_item_priority(
+        item: WorkItem,
+        compile_commands: typing.Dict[str, CCEntry],
+        realpath_cache: RealpathCache,
+) -> typing.Tuple[bool, int, int]:
+    warm = 0
+    for line in item.include_lines:
+        key = realpath_cache_key(
+            item.filepath, item.filepath_for_cc, line, compile_commands,
+        )
+        if realpath_cache.find(key) is not None:
+            warm += 1
+    warm_tenths = warm * 10 // len(item.include_lines) if warm else 0
+    return (not item.changed, -warm_tenths, -len(item.include_lines))
+
+
+# Reports the run progress: a bar on the terminal and/or
+# a stream of JSON events, one per line
+class Progress:
+    INTERVAL = 0.2
+    NDJSON_INTERVAL = 1.0
+    BAR_WIDTH = 30
+
+    def __init__(
+            self,
+            scheduler: ProbeScheduler,
+            realpath_cache: RealpathCache,
+            bar: bool,
+            ndjson: typing.Optional[typing.TextIO],
+    ):
+        self.scheduler = scheduler
+        self.realpath_cache = realpath_cache
+        self.bar = bar
+        self.ndjson = ndjson
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self._started_at = time.monotonic()
+        self._ndjson_at = 0.0
+        self._lock = threading.Lock()
+        self._output_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def add_total(self, count: int = 1) -> None:
+        with self._lock:
+            self.total += count
+
+    def add_done(self, count: int = 1) -> None:
+        with self._lock:
+            self.done += count
+
+    def add_skipped(self, count: int = 1) -> None:
+        with self._lock:
+            self.skipped += count
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total, done, skipped = self.total, self.done, self.skipped
+        elapsed = time.monotonic() - self._started_at
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = total - done - skipped
+        return {
+            'elapsed': round(elapsed, 3),
+            'done': done,
+            'skipped': skipped,
+            'total': total,
+            'files_per_sec': round(rate, 3),
+            'probes_in_flight': self.scheduler.in_flight,
+            'oldest_probe_age': round(self.scheduler.oldest_probe_age(), 3),
+            'cache_hit_rate': round(
+                self.realpath_cache.stats.hit_rate(), 3,
+            ),
+            'eta': round(remaining / rate, 3) if rate > 0 else None,
+        }
+
+    def _write_bar(self, state: dict, final: bool = False) -> None:
+        total = max(state['total'], 1)
+        filled = self.BAR_WIDTH * (state['done'] + state['skipped']) // total
+        eta = state['eta']
+        with self._output_lock:
+            sys.stderr.write(
+                '\r[{}{}] {}/{} files, {:.1f} files/s, {} probes, '
+                '{:.0%} cache hits, ETA {}'.format(
+                    '#' * filled,
+                    '.' * (self.BAR_WIDTH - filled),
+                    state['done'],
+                    state['total'],
+                    state['files_per_sec'],
+                    state['probes_in_flight'],
+                    state['cache_hit_rate'],
+                    f'{eta:.0f}s' if eta is not None else '?',
+                ),
+            )
+            if final:
+                sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    # Prints a message over the bar, the bar is redrawn by the next report
+    def log(self, message: str) -> None:
+        with self._output_lock:
+            if self.bar and self._thread.is_alive():
+                sys.stderr.write('\r\033[K')
+                sys.stderr.flush()
+            print(message, flush=True)
+
+    def _write_event(self, event: str, state: dict) -> None:
+        self.ndjson.write(json.dumps(dict(event=event, **state)) + '\n')
+        self.ndjson.flush()
+
+    def _report(self) -> None:
+        state = self.snapshot()
+        if self.bar:
+            self._write_bar(state)
+        now = time.monotonic()
+        if self.ndjson and now - self._ndjson_at >= self.NDJSON_INTERVAL:
+            self._ndjson_at = now
+            self._write_event('progress', state)
+
+    # Reports are made by timer, so a stalled run is visible too
+    def _run(self) -> None:
+        while not self._stop.wait(self.INTERVAL):
+            self._report()
+
+    def start(self) -> None:
+        self._started_at = time.monotonic()
+        if self.bar or self.ndjson:
+            self._thread.start()
+
+    def finish(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self._stop.set()
+        self._thread.join()
+
+        state = self.snapshot()
+        if self.bar:
+            self._write_bar(state, final=True)
+        if self.ndjson:
+            self._write_event('finished', state)
+
+
+def open_progress_ndjson(target: str) -> typing.TextIO:
+    if target.startswith('fd:'):
+        return open(int(target[len('fd:') :]), 'w', closefd=False)
+    return open(target, 'w')
+
+
+# Discovery, resolution with classification and writing are stages
+# connected with bounded queues. A .hpp is dispatched as soon as some .cpp
+# resolves an include of it, so .cpp and .hpp files are handled simultaneously.
+# Ready files are dispatched in the order of priority.
+#
+# The memory is bounded by the queue sizes, except for the headers which are
+# not included by any handled .cpp yet: they wait for a .cpp without a limit,
+# as a limit could block the discovery of that .cpp.
+class Pipeline:
+    # Max number of discovered, but not dispatched files
+    QUEUE_SIZE = 1024
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(
+            self,
+            jobs: int,
+            budget: TimeBudget,
+            include_map: IncludeMap,
+            is_source: typing.Callable[[str], bool],
+            is_header: typing.Callable[[str], bool],
+            # (path, path for compile_commands.json, include lines) -> item
+            make_item: typing.Callable[[str, str, typing.List[str]], WorkItem],
+            priority: typing.Callable[[WorkItem], typing.Any],
+            handle: typing.Callable[[WorkItem], typing.Optional[str]],
+            progress: typing.Optional[Progress] = None,
+            prefetcher: typing.Optional[AngleIncludePrefetcher] = None,
+    ):
+        self.jobs = jobs
+        self.progress = progress
+        self.prefetcher = prefetcher
+        self.budget = budget
+        self.include_map = include_map
+        self.is_source = is_source
+        self.is_header = is_header
+        self.make_item = make_item
+        self.priority = priority
+        self.handle = handle
+
+        self._events: queue.Queue = queue.Queue()
+        self._discovery_slots = threading.BoundedSemaphore(self.QUEUE_SIZE)
+        self._write_queue: queue.Queue = queue.Queue(maxsize=2 * jobs)
+        # (priority, counter, item, holds a discovery slot)
+        self._heap: typing.List[
+            typing.Tuple[typing.Any, int, WorkItem, bool]
+        ] = []
+        self._counter = 0
+        self._refreshed_at = time.monotonic()
+        # abs path -> (path, include lines) of .hpp files not included
+        # by any .cpp yet
+        self._pending_headers: typing.Dict[
+            str, typing.Tuple[str, typing.List[str]]
+        ] = {}
+        self._in_flight: typing.Set[concurrent.futures.Future] = set()
+        self._discovery_done = False
+        self._stopped = False
+        # Set once the time budget is exhausted
+        self._discovery_stop = threading.Event()
+        # The traversal was stopped before all the files were found
+        self.discovery_incomplete = False
+        self._unchecked: typing.List[str] = []
+
+        include_map.listener = lambda header: self._events.put(
+            ('resolved', header),
+        )
+
+    # The files are read here, so the dispatcher thread does no file I/O
+    def _discover(self, files: typing.Iterable[str]) -> None:
+        try:
+            for filepath in files:
+                self._discovery_slots.acquire()
+                if self._discovery_stop.is_set():
+                    # Nothing is dispatched anymore, don't waste time
+                    # on the rest of the tree
+                    self._discovery_slots.release()
+                    self.discovery_incomplete = True
+                    return
+                include_lines = (
+                    read_include_lines(filepath)
+                    if self.is_source(filepath) or self.is_header(filepath)
+                    else []
+                )
+                if self.prefetcher and self.is_source(filepath):
+                    self.prefetcher.add(filepath, include_lines)
+                self._events.put(('discovered', (filepath, include_lines)))
+            if self.prefetcher:
+                self.prefetcher.flush()
+        finally:
+            self._events.put(('discovery_done', None))
+
+    def _log(self, message: str) -> None:
+        if self.progress:
+            self.progress.log(message)
+        else:
+            print(message)
+
+    def _write(self) -> None:
+        while True:
+            entry = self._write_queue.get()
+            if entry is None:
+                return
+
+            filepath, contents = entry
+            try:
+                write_file_contents(filepath, contents)
+            except Exception as exc:
+                self._log(f'Failed to write "{filepath}" (the error: {exc})')
+
+    def _work(self, item: WorkItem) -> None:
+        start = time.monotonic()
+        try:
+            contents = self.handle(item)
+        finally:
+            if self.progress:
+                self.progress.add_done()
+        self.budget.record(time.monotonic() - start)
+        if contents is not None:
+            self._write_queue.put((item.filepath, contents))
+
+    def _push(self, item: WorkItem, holds_slot: bool) -> None:
+        if self._stopped:
+            self._unchecked.append(item.filepath)
+            if holds_slot:
+                self._discovery_slots.release()
+            return
+
+        self._counter += 1
+        heapq.heappush(
+            self._heap, (self.priority(item), self._counter, item, holds_slot),
+        )
+
+    def _pop(self) -> WorkItem:
+        _, _, item, holds_slot = heapq.heappop(self._heap)
+        if holds_slot:
+            self._discovery_slots.release()
+        return item
+
+    def _on_discovered(
+            self, filepath: str, include_lines: typing.List[str],
+    ) -> None:
+        if self.progress and (
+                self.is_source(filepath) or self.is_header(filepath)
+        ):
+            self.progress.add_total()
+
+        if self.is_source(filepath):
+            self._push(
+                self.make_item(filepath, filepath, include_lines),
+                holds_slot=True,
+            )
+            return
+        if not self.is_header(filepath):
+            self._discovery_slots.release()
+            return
+
+        abs_path = os.path.abspath(filepath)
+        init_cpp = self.include_map.data.get(abs_path)
+        if init_cpp:
+            self._push(
+                self.make_item(filepath, init_cpp, include_lines),
+                holds_slot=True,
+            )
+        else:
+            self._pending_headers[abs_path] = (filepath, include_lines)
+            self._discovery_slots.release()
+
+    def _on_resolved(self, header: str) -> None:
+        pending = self._pending_headers.pop(header, None)
+        if pending:
+            filepath, include_lines = pending
+            # The number of pending .hpp files is not limited anyway
+            self._push(
+                self.make_item(
+                    filepath, self.include_map.data[header], include_lines,
+                ),
+                holds_slot=False,
+            )
+
+    def _handle_event(self, event: typing.Tuple[str, typing.Any]) -> None:
+        kind, value = event
+        if kind == 'discovered':
+            self._on_discovered(*value)
+        elif kind == 'resolved':
+            self._on_resolved(value)
+        elif kind == 'done':
+            self._in_flight.discard(value)
+            value.result()
+        elif kind == 'discovery_done':
+            self._discovery_done = True
+
+    # The priority of ready items changes as the cache warms up,
+    # so the heap is rebuilt from time to time
+    def _refresh_heap(self) -> None:
+        if time.monotonic() - self._refreshed_at < self.REFRESH_INTERVAL:
+            return
+        self._heap = [
+            (self.priority(item), counter, item, holds_slot)
+            for _, counter, item, holds_slot in self._heap
+        ]
+        heapq.heapify(self._heap)
+        self._refreshed_at = time.monotonic()
+
+    def _stop(self) -> None:
+        # Stop dispatching, but let in-flight files finish
+        self._stopped = True
+        self._discovery_stop.set()
+        while self._heap:
+            self._unchecked.append(self._pop().filepath)
+
+    def _dispatch(self, executor: concurrent.futures.Executor) -> None:
+        self._refresh_heap()
+        while self._heap and len(self._in_flight) < self.jobs:
+            if not self.budget.allows_dispatch():
+                self._stop()
+                return
+
+            item = self._pop()
+            future = executor.submit(self._work, item)
+            self._in_flight.add(future)
+            future.add_done_callback(
+                lambda future: self._events.put(('done', future)),
+            )
+
+    # Returns the files which were not handled due to the time budget
+    def run(self, files: typing.Iterable[str]) -> typing.List[str]:
+        discovery = threading.Thread(
+            target=self._discover, args=(files,), daemon=True,
+        )
+        writer = threading.Thread(target=self._write)
+        discovery.start()
+        writer.start()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.jobs,
+            ) as executor:
+                while True:
+                    self._dispatch(executor)
+                    if (
+                            self._discovery_done
+                            and not self._heap
+                            and not self._in_flight
+                    ):
+                        break
+                    self._handle_event(self._events.get())
+        finally:
+            self._write_queue.put(None)
+            writer.join()
+
+        for filepath, _ in self._pending_headers.values():
+            if self._stopped:
+                self._unchecked.append(filepath)
+            else:
+                self._log(f'Error: no .cpp file includes "{filepath}"')
+        if self.progress:
+            self.progress.add_skipped(
+                len(self._unchecked)
+                + (0 if self._stopped else len(self._pending_headers)),
+            )
+        return self._unchecked
 
 
 def has_suffix(filepath: str, suffixes) -> bool:
@@ -764,51 +2589,316 @@ def main():
             'separated with comma.'
         ),
     )
+    parser.add_argument(
+        '--dump-resolutions',
+        type=str,
+        help=(
+            'Resolve all includes and save them to the file instead of '
+            'sorting. Use --replay to try rules against the file.'
+        ),
+    )
+    parser.add_argument(
+        '--replay',
+        type=str,
+        help=(
+            'Apply the rules to a file saved with --dump-resolutions. '
+            'Neither the compiler is run nor files are changed, the rules '
+            'statistics and the files which would be changed are reported.'
+        ),
+    )
+    parser.add_argument(
+        '--exclude',
+        '-e',
+        action='append',
+        default=[],
+        help=(
+            'Glob of file or directory names (or paths) to skip while '
+            'traversing the directory. Can be used multiple times.'
+        ),
+    )
+    parser.add_argument(
+        '--no-gitignore',
+        action='store_true',
+        help=(
+            'Do not skip files ignored by git (".gitignore" files, '
+            '".git/info/exclude" and "core.excludesFile").'
+        ),
+    )
+    parser.add_argument(
+        '--only-compile-db',
+        action='store_true',
+        help=(
+            'Skip source files missing in "compile_commands.json" '
+            'instead of reporting an error.'
+        ),
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=os.cpu_count() or 1,
+        help=(
+            'Number of files to handle in parallel. If run under GNU make '
+            'with jobserver, compiler probes are limited by jobserver tokens.'
+        ),
+    )
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        help='Show a progress bar if stderr is a terminal.',
+    )
+    parser.add_argument(
+        '--progress-ndjson',
+        type=str,
+        help=(
+            'Write progress events as JSON lines to the file '
+            '(or to a file descriptor with "fd:N"): files done and total, '
+            'files/s, running compiler probes, cache hit rate, ETA.'
+        ),
+    )
+    parser.add_argument(
+        '--no-spawn-helper',
+        action='store_true',
+        help=(
+            'Spawn compiler probes directly instead of via a small helper '
+            'process. Forking the tool itself gets slow as its heap grows.'
+        ),
+    )
+    parser.add_argument(
+        '--max-load',
+        '-l',
+        type=float,
+        help=(
+            'Do not start new compiler probes while the load average '
+            'is above the limit.'
+        ),
+    )
+    parser.add_argument(
+        '--min-free-memory',
+        type=int,
+        help=(
+            'Do not start new compiler probes while the available memory '
+            'is below the limit (in MiB).'
+        ),
+    )
+    parser.add_argument(
+        '--negative-cache-ttl',
+        type=float,
+        default=RealpathCache.DEFAULT_NEGATIVE_TTL,
+        help=(
+            'For how long (in seconds) to remember include resolution '
+            'failures instead of asking the compiler again.'
+        ),
+    )
+    parser.add_argument(
+        '--no-batch-resolution',
+        action='store_true',
+        help=(
+            'Do not resolve angle bracket includes of all source files '
+            'in advance with a compiler run per header search flags set.'
+        ),
+    )
+    parser.add_argument(
+        '--cache-max-entries',
+        type=int,
+        help='Max number of entries in the include resolution cache.',
+    )
+    parser.add_argument(
+        '--cache-max-memory',
+        type=int,
+        help='Approximate max size of the include resolution cache (in MiB).',
+    )
+    parser.add_argument(
+        '--time-budget',
+        type=float,
+        help=(
+            'Stop handling new files when the time budget (in seconds) '
+            'is about to be exhausted. Changed files are handled first, '
+            'then files with already resolved includes. '
+            'The files left unchecked are reported.'
+        ),
+    )
     args = parser.parse_args()
     process(args)
 
 
 def process(args):
+    if args.replay:
+        replay(args.replay, read_config(args.config))
+        return
+
+    # The helper must be started before the heap grows
+    helper = None
+    if not args.no_spawn_helper and os.name == 'posix':
+        helper = spawn_helper.SpawnHelper()
+
+    try:
+        do_process(args, helper)
+    finally:
+        if helper:
+            helper.close()
+
+
+def do_process(
+        args, helper: typing.Optional[spawn_helper.SpawnHelper],
+) -> None:
     suffixes = args.cpp_suffixes.split(',')
     hpp_suffixes = args.hpp_suffixes.split(',')
-    realpath_cache = RealpathCache()
+    realpath_cache = RealpathCache(
+        negative_ttl=args.negative_cache_ttl,
+        max_entries=args.cache_max_entries,
+        max_memory=(
+            args.cache_max_memory * 1024 * 1024
+            if args.cache_max_memory is not None
+            else None
+        ),
+    )
+    budget = TimeBudget(args.time_budget)
+    scheduler = ProbeScheduler(
+        jobserver=JobServer.from_makeflags(os.environ.get('MAKEFLAGS', '')),
+        max_load=args.max_load,
+        min_free_memory=(
+            args.min_free_memory * 1024 * 1024
+            if args.min_free_memory is not None
+            else None
+        ),
+        helper=helper,
+    )
     compile_commands = read_compile_commands(args.compile_commands)
     config = read_config(args.config)
     include_map = IncludeMap(data={})
+    include_tree = IncludeTree()
+    snapshot = (
+        ResolutionSnapshot(args.dump_resolutions)
+        if args.dump_resolutions
+        else None
+    )
 
-    headers = collect_all_files(args.paths, suffixes + hpp_suffixes)
+    file_filter = FileFilter(
+        suffixes + hpp_suffixes,
+        excludes=args.exclude,
+        use_gitignore=not args.no_gitignore,
+    )
+    # It is worth spending time on it only if not every file is handled
+    changed_files = (
+        collect_changed_files(args.paths)
+        if args.time_budget is not None
+        else set()
+    )
 
-    # process .cpp
-    for hdr in headers:
-        if has_suffix(hdr, suffixes):
-            handle_single_file(
-                hdr,
-                hdr,
-                compile_commands,
-                args,
-                realpath_cache,
-                config,
-                include_map,
-            )
+    def is_source(filepath: str) -> bool:
+        return has_suffix(filepath, suffixes)
+
+    def is_header(filepath: str) -> bool:
+        return has_suffix(filepath, hpp_suffixes)
+
+    def make_item(
+            filepath: str,
+            filepath_for_cc: str,
+            include_lines: typing.List[str],
+    ) -> WorkItem:
+        return WorkItem(
+            filepath=filepath,
+            filepath_for_cc=filepath_for_cc,
+            include_lines=include_lines,
+            changed=os.path.realpath(filepath) in changed_files,
+        )
+
+    def priority(item: WorkItem) -> typing.Any:
+        return work_item_priority(item, compile_commands, realpath_cache)
+
+    def handle(item: WorkItem) -> typing.Optional[str]:
+        return handle_single_file(
+            item.filepath,
+            item.filepath_for_cc,
+            compile_commands,
+            args,
+            realpath_cache,
+            scheduler,
+            include_tree,
+            config,
+            include_map if is_source(item.filepath) else None,
+            snapshot,
+            progress,
+        )
 
-    # process .hpp
-    for hdr in headers:
-        if has_suffix(hdr, hpp_suffixes):
-            abs_path = os.path.abspath(hdr)
-            init_cpp = include_map.data.get(abs_path)
-            if not init_cpp:
-                print(f'Error: no .cpp file includes "{hdr}"')
+    def discover() -> typing.Iterable[str]:
+        for filepath in discover_files(args.paths, file_filter, args.jobs):
+            if (
+                    args.only_compile_db
+                    and is_source(filepath)
+                    and os.path.abspath(filepath) not in compile_commands
+            ):
                 continue
+            yield filepath
+
+    progress = Progress(
+        scheduler,
+        realpath_cache,
+        bar=args.progress and sys.stderr.isatty(),
+        ndjson=(
+            open_progress_ndjson(args.progress_ndjson)
+            if args.progress_ndjson
+            else None
+        ),
+    )
+    prefetcher = (
+        AngleIncludePrefetcher(
+            compile_commands,
+            realpath_cache,
+            scheduler,
+            include_tree,
+            budget,
+            args.jobs,
+        )
+        if not args.no_batch_resolution
+        else None
+    )
+    pipeline = Pipeline(
+        args.jobs,
+        budget,
+        include_map,
+        is_source,
+        is_header,
+        make_item,
+        priority,
+        handle,
+        progress,
+        prefetcher,
+    )
+    progress.start()
+    try:
+        unchecked = pipeline.run(discover())
+    finally:
+        if prefetcher:
+            prefetcher.close()
+        progress.finish()
+        if progress.ndjson:
+            progress.ndjson.close()
+        if snapshot:
+            snapshot.close()
+
+    if prefetcher:
+        print(
+            f'Resolved angle bracket includes in {prefetcher.batches} '
+            f'batches.',
+        )
 
-            handle_single_file(
-                hdr,
-                init_cpp,
-                compile_commands,
-                args,
-                realpath_cache,
-                config,
-                IncludeMap({}),
-            )
+    stats = realpath_cache.stats
+    print(
+        f'Include resolution cache: {stats.hits} hits, {stats.misses} misses, '
+        f'{stats.evictions} evictions.',
+    )
+
+    if unchecked or pipeline.discovery_incomplete:
+        print(
+            f'The time budget is exhausted, '
+            f'{len(unchecked)} files are left unchecked:',
+        )
+        for filepath in unchecked:
+            print(f'  {filepath}')
+        if pipeline.discovery_incomplete:
+            print('  (the rest of the files are not discovered)')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# A small process which spawns compiler probes on behalf of the main process.
+# Forking the main process with a huge heap (e.g. with a loaded
+# compile_commands.json) is slow, forking the helper is cheap regardless
+# of the main process size.
+#
+# The helper must not import anything but the standard library.
+
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import threading
+import typing
+
+HEADER = struct.Struct('<I')
+
+
+def write_frame(ofile: typing.BinaryIO, obj: typing.Any) -> None:
+    data = pickle.dumps(obj)
+    ofile.write(HEADER.pack(len(data)))
+    ofile.write(data)
+    ofile.flush()
+
+
+def read_frame(ifile: typing.BinaryIO) -> typing.Any:
+    header = ifile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise EOFError()
+    (size,) = HEADER.unpack(header)
+    data = ifile.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return pickle.loads(data)
+
+
+# Request: (request_id, command_items, input, timeout, cwd)
+# Response: (request_id, return_code, stdout, stderr, error)
+def serve(ifile: typing.BinaryIO, ofile: typing.BinaryIO) -> None:
+    lock = threading.Lock()
+
+    def handle(request: typing.Tuple) -> None:
+        request_id, command_items, input_data, timeout, cwd = request
+        try:
+            proc = subprocess.run(
+                command_items,
+                cwd=cwd,
+                input=input_data,
+                stdin=None if input_data is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+            response = (
+                request_id, proc.returncode, proc.stdout, proc.stderr, None,
+            )
+        except Exception as exc:
+            response = (request_id, None, b'', b'', str(exc))
+
+        with lock:
+            write_frame(ofile, response)
+
+    while True:
+        try:
+            request = read_frame(ifile)
+        except EOFError:
+            return
+        threading.Thread(target=handle, args=(request,), daemon=True).start()
+
+
+class SpawnHelper:
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # request_id -> (event, response)
+        self._waiters: typing.Dict[int, typing.List[typing.Any]] = {}
+        self._closed = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self) -> None:
+        while True:
+            try:
+                response = read_frame(self._proc.stdout)
+            except (EOFError, OSError, pickle.UnpicklingError):
+                break
+
+            with self._lock:
+                waiter = self._waiters.pop(response[0], None)
+            if waiter:
+                waiter[1] = response
+                waiter[0].set()
+
+        # Wake up everybody, the helper is gone
+        with self._lock:
+            self._closed = True
+            waiters = list(self._waiters.values())
+            self._waiters.clear()
+        for waiter in waiters:
+            waiter[0].set()
+
+    def run(
+            self,
+            command_items: typing.List[str],
+            input_data: typing.Optional[bytes] = None,
+            timeout: typing.Optional[float] = None,
+            cwd: typing.Optional[str] = None,
+    ) -> typing.Tuple[int, bytes, bytes]:
+        waiter: typing.List[typing.Any] = [threading.Event(), None]
+        with self._lock:
+            if self._closed:
+                raise Exception('spawn helper is not running')
+            request_id = self._next_id
+            self._next_id += 1
+            self._waiters[request_id] = waiter
+            write_frame(
+                self._proc.stdin,
+                (request_id, command_items, input_data, timeout, cwd),
+            )
+
+        waiter[0].wait()
+        response = waiter[1]
+        if response is None:
+            raise Exception('spawn helper has exited unexpectedly')
+
+        _, return_code, out, err, error = response
+        if error is not None:
+            raise Exception(error)
+        return return_code, out, err
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._proc.stdin.close()
+        self._proc.wait()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin.buffer, sys.stdout.buffer)
@@ -1,7 +1,11 @@
 import typing
 import pytest
 import dataclasses
+import itertools
 import json
+import os
+import subprocess
+import threading
 
 from . import sort_cpp_includes
 
@@ -13,6 +17,22 @@ class FakeArgs:
     config: str
     hpp_suffixes: str
     cpp_suffixes: str
+    dump_resolutions: typing.Optional[str] = None
+    replay: typing.Optional[str] = None
+    exclude: typing.Sequence[str] = ()
+    no_gitignore: bool = False
+    only_compile_db: bool = False
+    jobs: int = 1
+    progress: bool = False
+    progress_ndjson: typing.Optional[str] = None
+    no_spawn_helper: bool = False
+    max_load: typing.Optional[float] = None
+    min_free_memory: typing.Optional[int] = None
+    negative_cache_ttl: float = 600.0
+    no_batch_resolution: bool = False
+    cache_max_entries: typing.Optional[int] = None
+    cache_max_memory: typing.Optional[int] = None
+    time_budget: typing.Optional[float] = None
 
 
 # TODO: ad-hoc
@@ -123,3 +143,662 @@ def test_multiple_groups(tmp_path, check):
                 ],
             }
     check(input_cpp, expected_output, rules)
+
+
+def test_code_after_includes(tmp_path, check):
+    input_cpp="""
+#include <iostream>
+#include <atomic>
+
+int main() {}
+"""
+
+    expected_output="""#include <atomic>
+#include <iostream>
+
+int main() {}
+"""
+
+    rules = {'rules': [{'matchers': [{'regex': '.*'}]}]}
+    check(input_cpp, expected_output, rules)
+
+
+def test_jobserver_tokens():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'+')
+
+    jobserver = sort_cpp_includes.JobServer.from_makeflags(
+        f' -j4 --jobserver-auth={read_fd},{write_fd}',
+    )
+    scheduler = sort_cpp_includes.ProbeScheduler(jobserver=jobserver)
+
+    # the implicit token + a single token from the pipe
+    with scheduler.slot():
+        with scheduler.slot():
+            assert scheduler.in_flight == 2
+    assert os.read(read_fd, 1) == b'+'
+
+    assert sort_cpp_includes.JobServer.from_makeflags('-j4') is None
+
+
+def test_jobserver_nonblocking():
+    # make >= 4.3 passes the read end with O_NONBLOCK set
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    jobserver = sort_cpp_includes.JobServer(read_fd, write_fd)
+
+    # No free token yet: wait for it
+    timer = threading.Timer(0.1, lambda: os.write(write_fd, b'+'))
+    timer.start()
+    assert jobserver.acquire() == b'+'
+    timer.join()
+    assert not os.get_blocking(read_fd)
+
+
+def test_jobserver_failed_acquire():
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    jobserver = sort_cpp_includes.JobServer(read_fd, write_fd)
+    scheduler = sort_cpp_includes.ProbeScheduler(jobserver=jobserver)
+
+    with scheduler.slot():
+        # The pipe is closed, the implicit token is still taken
+        with pytest.raises(Exception):
+            with scheduler.slot():
+                pass
+        assert not scheduler._implicit_token_free
+    assert scheduler._implicit_token_free
+
+
+def make_pipeline(jobs, budget, handle):
+    return sort_cpp_includes.Pipeline(
+        jobs,
+        budget,
+        sort_cpp_includes.IncludeMap({}),
+        is_source=lambda path: path.endswith('.cpp'),
+        is_header=lambda path: path.endswith('.hpp'),
+        make_item=lambda path, path_for_cc, _: sort_cpp_includes.WorkItem(
+            filepath=path,
+            filepath_for_cc=path_for_cc,
+            include_lines=['#include <x>'] * len(path),
+            changed=path.startswith('changed'),
+        ),
+        priority=lambda item: sort_cpp_includes.work_item_priority(
+            item, {}, sort_cpp_includes.RealpathCache(),
+        ),
+        handle=handle,
+    )
+
+
+def test_time_budget_priority():
+    files = ['a.cpp', 'changed.cpp', 'long_name.cpp']
+    pipeline = make_pipeline(1, sort_cpp_includes.TimeBudget(None), None)
+    items = [pipeline.make_item(path, path, []) for path in files]
+    assert [
+        item.filepath for item in sorted(items, key=pipeline.priority)
+    ] == ['changed.cpp', 'long_name.cpp', 'a.cpp']
+
+    handled = []
+    pipeline = make_pipeline(
+        1,
+        sort_cpp_includes.TimeBudget(0),
+        lambda item: handled.append(item.filepath),
+    )
+    unchecked = pipeline.run(files)
+    assert set(unchecked) <= set(files)
+    # The discovery may be stopped before all the files are found
+    assert len(unchecked) == len(files) or pipeline.discovery_incomplete
+    assert handled == []
+
+
+def test_time_budget_stops_discovery():
+    handled = []
+    pipeline = make_pipeline(
+        1,
+        sort_cpp_includes.TimeBudget(0),
+        lambda item: handled.append(item.filepath),
+    )
+    # An endless tree: run() returns only if the discovery is stopped
+    files = (f'{i}.cpp' for i in itertools.count())
+    assert pipeline.run(files)
+    assert pipeline.discovery_incomplete
+    assert handled == []
+
+
+def test_pipeline_headers():
+    handled = []
+
+    def handle(item):
+        handled.append(item.filepath)
+        if item.filepath == 'a.cpp':
+            pipeline.include_map.add(os.path.abspath('a.hpp'), 'a.cpp')
+
+    pipeline = make_pipeline(2, sort_cpp_includes.TimeBudget(None), handle)
+    assert pipeline.run(['a.hpp', 'b.hpp', 'a.cpp']) == []
+    assert sorted(handled) == ['a.cpp', 'a.hpp']
+
+
+def test_read_include_lines(tmp_path):
+    path = tmp_path / 'a.hpp'
+    path.write_text(
+        '#pragma once\n\n#include <b.hpp>\n#include "c.hpp"\n\n'
+        'int x;\n#include <d.hpp>\n',
+    )
+    assert sort_cpp_includes.read_include_lines(str(path)) == [
+        '#include <b.hpp>', '#include "c.hpp"',
+    ]
+
+
+def test_ignore_file(tmp_path):
+    (tmp_path / '.gitignore').write_text(
+        '*.log\n!keep.log\nbuild/\n/gen/*.cpp\n',
+    )
+    ignore_file = sort_cpp_includes.read_gitignore(str(tmp_path))
+
+    assert ignore_file.match('x.log', is_dir=False)
+    assert ignore_file.match('src/x.log', is_dir=False)
+    # The last matching pattern wins
+    assert ignore_file.match('src/keep.log', is_dir=False) is False
+    assert ignore_file.match('src/build', is_dir=True)
+    assert ignore_file.match('src/build', is_dir=False) is None
+    assert ignore_file.match('gen/x.cpp', is_dir=False)
+    assert ignore_file.match('src/gen/x.cpp', is_dir=False) is None
+
+
+def test_collect_files(tmp_path):
+    for path in [
+            'src/main.cpp',
+            'src/main.hpp',
+            'src/readme.txt',
+            'src/generated/gen.cpp',
+            'build/main.cpp',
+            'third_party/lib/lib.hpp',
+            '.git/x.cpp',
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    (tmp_path / '.gitignore').write_text('/build/\n')
+    (tmp_path / 'src' / '.gitignore').write_text('generated\n')
+
+    file_filter = sort_cpp_includes.FileFilter(
+        ['.cpp', '.hpp'], excludes=['third_party'], use_gitignore=True,
+    )
+    files = sort_cpp_includes.discover_files(
+        [str(tmp_path)], file_filter, jobs=4,
+    )
+    assert sorted(files) == [
+        str(tmp_path / 'src/main.cpp'), str(tmp_path / 'src/main.hpp'),
+    ]
+
+
+def test_collect_files_parent_gitignore(tmp_path):
+    for path in [
+            'src/main.cpp',
+            'src/generated/gen.cpp',
+            'src/local.cpp',
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    subprocess.check_call(['git', 'init', '-q', str(tmp_path)])
+    (tmp_path / '.gitignore').write_text('generated/\n')
+    (tmp_path / '.git' / 'info').mkdir(exist_ok=True)
+    (tmp_path / '.git' / 'info' / 'exclude').write_text('local.cpp\n')
+
+    file_filter = sort_cpp_includes.FileFilter(
+        ['.cpp'], excludes=[], use_gitignore=True,
+    )
+    files = sort_cpp_includes.discover_files(
+        [str(tmp_path / 'src')], file_filter,
+    )
+    assert list(files) == [str(tmp_path / 'src/main.cpp')]
+
+
+def test_realpath_cache_key():
+    def make_entry(file_path, flags):
+        return sort_cpp_includes.CCEntry(
+            directory='/build',
+            command=['g++'] + flags + ['-c', file_path, '-o', 'file.o'],
+            file_path=file_path,
+        )
+
+    compile_commands = {
+        '/src/a.cpp': make_entry('/src/a.cpp', ['-I/inc', '-DA']),
+        '/src/b.cpp': make_entry('/src/b.cpp', ['-I/inc', '-DB']),
+        '/src/c.cpp': make_entry('/src/c.cpp', ['-I/other']),
+    }
+
+    def key(filename):
+        return sort_cpp_includes.realpath_cache_key(
+            filename, filename, '#include "x.hpp"', compile_commands,
+        )
+
+    # Only the header search flags matter
+    assert key('/src/a.cpp') == key('/src/b.cpp')
+    assert key('/src/a.cpp') != key('/src/c.cpp')
+
+
+def test_realpath_cache_single_flight():
+    cache = sort_cpp_includes.RealpathCache()
+    key = sort_cpp_includes.RealpathCacheKey(
+        include_line='#include <missing.h>', flags=(), directory=None,
+    )
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def resolve():
+        calls.append(1)
+        started.set()
+        release.wait()
+        raise sort_cpp_includes.ResolutionError('Header not found')
+
+    def lookup():
+        with pytest.raises(Exception, match='Header not found'):
+            cache.get_or_resolve(key, resolve)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # The failure is cached too
+    lookup()
+    assert len(calls) == 1
+
+    cache.negative_ttl = 0
+    cache.set_failure(key, 'expired')
+    assert cache.get_or_resolve(key, lambda: 'path') == 'path'
+
+
+def test_realpath_cache_transient_error():
+    cache = sort_cpp_includes.RealpathCache()
+    key = sort_cpp_includes.RealpathCacheKey(
+        include_line='#include <lib.h>', flags=(), directory=None,
+    )
+
+    def resolve():
+        raise subprocess.TimeoutExpired(['cc'], 10)
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        cache.get_or_resolve(key, resolve)
+    # Only the failures to resolve are cached
+    assert cache.get_or_resolve(key, lambda: 'path') == 'path'
+
+
+def test_lazy_real_path():
+    resolved = []
+
+    def make_include(path, real_path):
+        def resolve():
+            resolved.append(path)
+            return real_path
+
+        return sort_cpp_includes.Include(
+            include_line=f'#include <{path}>', orig_path=path, resolver=resolve,
+        )
+
+    includes = [
+        make_include('vector', '/usr/include/c++/vector'),
+        make_include('stdio.h', '/usr/include/stdio.h'),
+        make_include('input.hpp', '/src/input.hpp'),
+        make_include('lib.hpp', '/usr/include/lib.hpp'),
+    ]
+    config = sort_cpp_includes.Config(sort_cpp_includes.DEFAULT_RULES)
+    result = sort_cpp_includes.sort_includes(includes, '/src/input.cpp', config)
+    assert result == [
+        ['#include <input.hpp>'],
+        ['#include <stdio.h>'],
+        ['#include <vector>'],
+        ['#include <lib.hpp>'],
+        [],
+    ]
+    assert sorted(resolved) == ['input.hpp', 'lib.hpp']
+
+
+def test_no_pair_header_rule():
+    resolved = []
+
+    def resolve():
+        resolved.append('stdio.h')
+        return '/usr/include/stdio.h'
+
+    includes = [
+        sort_cpp_includes.Include(
+            include_line='#include <stdio.h>',
+            orig_path='stdio.h',
+            resolver=resolve,
+        ),
+    ]
+    config = sort_cpp_includes.Config(
+        {'rules': [{'matchers': [{'virtual': '@std-c'}]}]},
+    )
+    result = sort_cpp_includes.sort_includes(includes, '/src/stdio.cpp', config)
+    assert result == [['#include <stdio.h>']]
+    # The pair header is not searched for without a '@pair' rule
+    assert not resolved
+
+
+def test_realpath_cache_lru():
+    def make_key(name, directory='/src'):
+        return sort_cpp_includes.RealpathCacheKey(
+            include_line=f'#include "{name}"', flags=(), directory=directory,
+        )
+
+    cache = sort_cpp_includes.RealpathCache(max_entries=2)
+    cache.set(make_key('a.hpp'), '/src/a.hpp')
+    cache.set(make_key('b.hpp'), '/src/b.hpp')
+    assert cache.get_or_resolve(make_key('a.hpp'), None) == '/src/a.hpp'
+    cache.set(make_key('c.hpp'), '/src/c.hpp')
+
+    assert cache.find(make_key('b.hpp')) is None
+    assert cache.find(make_key('a.hpp')) == '/src/a.hpp'
+    assert cache.stats.hits == 1
+    assert cache.stats.evictions == 1
+
+    assert cache.invalidate_file('/src/a.hpp') == 1
+    cache.set(make_key('d.hpp', directory='/other'), '/src/d.hpp')
+    assert cache.invalidate_directory('/src') == 2
+    assert not cache.cache
+    assert cache.memory == 0
+
+
+def test_realpath_cache_flags_memory():
+    flags = ('g++', '-I/usr/include/' + 'x' * 1000)
+    cache = sort_cpp_includes.RealpathCache()
+    for name in ('a.hpp', 'b.hpp'):
+        cache.set(
+            sort_cpp_includes.RealpathCacheKey(
+                include_line=f'#include <{name}>', flags=flags, directory=None,
+            ),
+            f'/usr/include/{name}',
+        )
+    # The shared flags are counted once
+    assert 1000 < cache.memory < 2000
+    assert cache.invalidate(lambda key, value: True) == 2
+    assert cache.memory == 0
+
+
+def test_iterate_includes():
+    out = '\n'.join([
+        '# 0 "main.cpp"',
+        '# 0 "<built-in>"',
+        '# 0 "<command-line>"',
+        '# 1 "/usr/include/stdc-predef.h" 1 3 4',
+        '# 0 "<command-line>" 2',
+        '# 1 "main.cpp"',
+        'SORT_CPP_INCLUDES_BATCH_0',
+        '# 1 "/inc/a.hpp" 1',
+        '# 1 "/inc/nested.hpp" 1',
+        '# 2 "/inc/a.hpp" 2',
+        '# 3 "main.cpp" 2',
+    ])
+    includes = [
+        (parent, child)
+        for parent, child, _ in sort_cpp_includes.iterate_includes(out)
+        if child
+    ]
+    assert includes == [
+        ('<command-line>', '/usr/include/stdc-predef.h'),
+        ('main.cpp', '/inc/a.hpp'),
+        ('/inc/a.hpp', '/inc/nested.hpp'),
+    ]
+
+
+def test_angle_include_prefetcher(monkeypatch):
+    batches = []
+
+    def include_realpath_batch(command, include_lines, scheduler, tree):
+        batches.append(include_lines)
+        return {
+            line: '/inc/' + sort_cpp_includes.extract_file_relpath(line)
+            for line in include_lines
+        }
+
+    monkeypatch.setattr(
+        sort_cpp_includes, 'include_realpath_batch', include_realpath_batch,
+    )
+
+    def make_entry(file_path):
+        return sort_cpp_includes.CCEntry(
+            directory='/build',
+            command=['g++', '-I/inc', '-c', file_path],
+            file_path=file_path,
+        )
+
+    compile_commands = {
+        '/src/a.cpp': make_entry('/src/a.cpp'),
+        '/src/b.cpp': make_entry('/src/b.cpp'),
+    }
+
+    def run(budget):
+        cache = sort_cpp_includes.RealpathCache()
+        prefetcher = sort_cpp_includes.AngleIncludePrefetcher(
+            compile_commands,
+            cache,
+            sort_cpp_includes.ProbeScheduler(),
+            sort_cpp_includes.IncludeTree(),
+            budget,
+            jobs=2,
+        )
+        prefetcher.BATCH_SIZE = 2
+        prefetcher.add(
+            '/src/a.cpp',
+            ['#include <x.hpp>', '#include <vector>', '#include "a.hpp"'],
+        )
+        prefetcher.add(
+            '/src/b.cpp',
+            ['#include <x.hpp>', '#include <y.hpp>', '#include <z.hpp>'],
+        )
+        prefetcher.flush()
+        prefetcher.wait()
+        return cache
+
+    cache = run(sort_cpp_includes.TimeBudget(None))
+    assert sorted(batches) == [
+        ['#include <x.hpp>', '#include <y.hpp>'], ['#include <z.hpp>'],
+    ]
+    key = sort_cpp_includes.RealpathCacheKey(
+        include_line='#include <z.hpp>',
+        flags=compile_commands['/src/a.cpp'].include_flags(),
+        directory=None,
+    )
+    assert cache.find(key) == '/inc/z.hpp'
+
+    # No batches are run if the time budget is exhausted
+    batches.clear()
+    run(sort_cpp_includes.TimeBudget(0))
+    assert not batches
+
+
+def test_spawn_helper():
+    helper = sort_cpp_includes.spawn_helper.SpawnHelper()
+    try:
+        assert helper.run(['cat'], b'data', 10) == (0, b'data', b'')
+        with pytest.raises(Exception):
+            helper.run(['/nonexistent'], None, 10)
+    finally:
+        helper.close()
+
+
+def test_replay(tmp_path, capsys):
+    snapshot_fname = str(tmp_path / 'snapshot.jsonl')
+    snapshot = sort_cpp_includes.ResolutionSnapshot(snapshot_fname)
+    snapshot.add(
+        'src/sorted.cpp',
+        ['#include <stdio.h>', '', '#include <lib.hpp>', ''],
+        {
+            '#include <stdio.h>': '/usr/include/stdio.h',
+            '#include <lib.hpp>': '/usr/include/lib.hpp',
+        },
+    )
+    snapshot.add(
+        'src/unsorted.cpp',
+        ['#include <lib.hpp>', '#include <vector>'],
+        {
+            '#include <lib.hpp>': '/usr/include/lib.hpp',
+            '#include <vector>': '/usr/include/c++/vector',
+        },
+    )
+    snapshot.close()
+
+    config = sort_cpp_includes.Config(sort_cpp_includes.DEFAULT_RULES)
+    sort_cpp_includes.replay(snapshot_fname, config)
+    out = capsys.readouterr().out
+    assert '#1 [{"virtual": "@std-c"}]: 1' in out
+    assert '#3 [{"regex": "/usr/include/.*"}]: 2' in out
+    assert '1 files would be changed:\n  src/unsorted.cpp\n' in out
+
+
+def test_absolutize_command_paths():
+    assert sort_cpp_includes.absolutize_command_paths(
+        [
+            'bin/clang++',
+            '-Iinclude',
+            '-isystem',
+            'third_party',
+            '-I/usr/include',
+            '-DNAME=value',
+        ],
+        '/build',
+    ) == [
+        '/build/bin/clang++',
+        '-I/build/include',
+        '-isystem',
+        '/build/third_party',
+        '-I/usr/include',
+        '-DNAME=value',
+    ]
+
+
+def test_adjust_cc_command(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'args.rsp').write_text('-Iinc -MMD -MF"obj/x.d"\n')
+    command = sort_cpp_includes.CCEntry(
+        directory=str(tmp_path),
+        command=[
+            'g++', '-MD', '-MQ', 'obj/m.o', '-MF', 'obj/m.o.d',
+            '@args.rsp', '-Wp,-MD,obj/.m.o.d', '-c', 'm.cpp', '-o', 'obj/m.o',
+        ],
+        file_path=str(tmp_path / 'm.cpp'),
+    )
+    assert sort_cpp_includes.adjust_cc_command(command) == [
+        'g++', '-Iinc', '-H', '-E',
+    ]
+
+
+def test_include_realpath_dependency_flags(tmp_path, monkeypatch):
+    # Meson-style command run from the build directory
+    (tmp_path / 'build').mkdir()
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'include').mkdir()
+    (tmp_path / 'include' / 'x.hpp').write_text('')
+    (tmp_path / 'src' / 'm.cpp').write_text('#include <x.hpp>\n')
+    (tmp_path / 'build' / 'args.rsp').write_text('-I../include\n')
+    monkeypatch.chdir(tmp_path / 'build')
+
+    source = str(tmp_path / 'src' / 'm.cpp')
+    command = sort_cpp_includes.CCEntry(
+        directory=str(tmp_path / 'build'),
+        command=[
+            COMPILER, '@args.rsp', '-MD', '-MQ', 'obj/m.o', '-MF',
+            'obj/m.o.d', '-c', source, '-o', 'obj/m.o',
+        ],
+        file_path=source,
+    )
+    assert sort_cpp_includes.include_realpath(
+        source,
+        source,
+        '#include <x.hpp>',
+        {source: command},
+        sort_cpp_includes.ProbeScheduler(),
+        sort_cpp_includes.IncludeTree(),
+    ) == str(tmp_path / 'include' / 'x.hpp')
+    # No dependency files are written
+    assert not list(tmp_path.rglob('*.d'))
+
+
+def test_progress_ndjson(tmp_path):
+    ndjson_fname = tmp_path / 'progress.ndjson'
+    progress = sort_cpp_includes.Progress(
+        sort_cpp_includes.ProbeScheduler(),
+        sort_cpp_includes.RealpathCache(),
+        bar=False,
+        ndjson=open(ndjson_fname, 'w'),
+    )
+    pipeline = make_pipeline(
+        2, sort_cpp_includes.TimeBudget(None), lambda item: None,
+    )
+    pipeline.progress = progress
+
+    progress.start()
+    pipeline.run(['a.cpp', 'b.cpp', 'c.hpp'])
+    progress.finish()
+    progress.ndjson.close()
+
+    with open(ndjson_fname) as ifile:
+        events = [json.loads(line) for line in ifile]
+    assert events[-1]['event'] == 'finished'
+    assert events[-1]['done'] == 2
+    assert events[-1]['skipped'] == 1
+    assert events[-1]['total'] == 3
+
+
+def test_include_tree():
+    out = '\n'.join([
+        '# 1 "<stdin>"',
+        '# 1 "/inc/lib/a.hpp" 1',
+        '# 1 "/inc/lib/y.hpp" 1',
+        '# 1 "/inc/lib/x.hpp" 1',
+        'int lib_x;',
+        '# 3 "/inc/lib/y.hpp" 2',
+        '# 2 "/inc/lib/a.hpp" 2',
+        '# 1 "/inc/other/x.hpp" 1',
+        'int other_x;',
+        '# 3 "/inc/lib/a.hpp" 2',
+        '# 1 "/usr/include/vector" 1 3',
+        '# 1 "/usr/include/bits/stl_vector.h" 1 3',
+        '# 2 "/usr/include/vector" 2 3',
+        '# 5 "/inc/lib/a.hpp" 2',
+        '# 2 "<stdin>" 2',
+    ])
+    tree = sort_cpp_includes.IncludeTree()
+    tree.add_output(('-I/inc',), out, '/')
+
+    def find(header, line_number, flags=('-I/inc',)):
+        return tree.find(flags, header, line_number)
+
+    assert find('/inc/lib/a.hpp', 1) == '/inc/lib/y.hpp'
+    assert find('/inc/lib/a.hpp', 2) == '/inc/other/x.hpp'
+    # '#include "x.hpp"' at line 3 is skipped due to '#pragma once'
+    assert find('/inc/lib/a.hpp', 3) is None
+    assert find('/inc/lib/a.hpp', 4) == '/usr/include/vector'
+    assert find('/inc/lib/y.hpp', 2) == '/inc/lib/x.hpp'
+    assert find('/inc/lib/a.hpp', 1, flags=('-I/other',)) is None
+    # Includes of system headers are not recorded
+    assert find('/usr/include/vector', 1) is None
+
+    # The least recently used headers are dropped
+    tree = sort_cpp_includes.IncludeTree(max_headers=1)
+    tree.add_output(('-I/inc',), out, '/')
+    assert len(tree.data) == 1
+
+
+def test_progress_log(capsys):
+    progress = sort_cpp_includes.Progress(
+        sort_cpp_includes.ProbeScheduler(),
+        sort_cpp_includes.RealpathCache(),
+        bar=True,
+        ndjson=None,
+    )
+    progress.start()
+    progress.log('Failed to process "a.cpp"')
+    progress.finish()
+
+    captured = capsys.readouterr()
+    assert captured.out == 'Failed to process "a.cpp"\n'
+    # The bar line is cleared before the message
+    assert captured.err.startswith('\r\033[K')